@@ -1,24 +1,41 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
-from simple_salesforce import Salesforce
+from simple_salesforce import Salesforce, format_soql
+from simple_salesforce.exceptions import SalesforceExpiredSession
 from dotenv import load_dotenv
 import openpyxl
 from copy import copy as style_copy
+from openpyxl.cell.cell import Cell
 from openpyxl.utils import get_column_letter
+from openpyxl.writer.excel import ExcelWriter
 from openpyxl.styles import Alignment, Font, Border, Side
+from openpyxl.styles.numbers import BUILTIN_FORMATS_MAX_SIZE
 from openpyxl.drawing.image import Image as OpenpyxlImage
 from openpyxl.cell.rich_text import CellRichText, TextBlock, InlineFont
 # from openpyxl.styles.fonts import InlineFont
 from pathlib import Path
-import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import os
+from functools import lru_cache
+from operator import itemgetter
 import json
+import orjson
 import html
 import io
+from itertools import chain
+import pickle
 import re
+import tempfile
+import threading
+import time
+import zipfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 from num2words import num2words
 from groq import Groq
 
@@ -33,6 +50,7 @@ SF_CASE_ID_DEFAULT = '500fD00000XSvMwQAL'
 BASE_SERVICE_ID = "7204"
 BASE_BLOCK_ID_CREATE = "7210"
 BASE_USERNAME = "PhuongTran"
+SERVICE_ACCESS_TOKEN = os.getenv("SERVICE_ACCESS_TOKEN")  # read once, after load_dotenv()
 
 KEYS = {
     "MA_KH": "service_ma_khach_hang",
@@ -48,6 +66,17 @@ URL_GET_DETAIL = "https://service.base.vn/extapi/v1/ticket/get.detail"
 URL_CREATE = "https://service.base.vn/extapi/v1/ticket/create"
 URL_EDIT_CUSTOM = "https://service.base.vn/extapi/v1/ticket/edit.custom.fields"
 
+# One pooled, keep-alive session for every Base.vn call. Retry covers connection
+# errors and 502/503/504 answers; urllib3 does not retry POST on a bad status,
+# so a ticket is never created twice
+BASE_SESSION = requests.Session()
+BASE_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
+BASE_TIMEOUT = (5, 30)  # (connect, read) seconds
+
 
 app = FastAPI(title="Salesforce Packing List API")
 
@@ -64,64 +93,102 @@ app.add_middleware(
 class ShipmentRequest(BaseModel):
     shipment_id: str
 
-def expand_items_table(ws, template_row, n):
-    """Expand the items table to accommodate n rows"""
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=template_row, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
+def insert_rows_keeping_merges(ws, idx, amount):
+    """
+    ws.insert_rows(idx, amount) that also moves the merged ranges at or below idx.
+    
+    insert_rows already moves the MergedCell placeholders but not the ranges, so
+    the ranges are taken out of the set, shifted and put back, instead of an
+    unmerge/merge string round trip per range.
+    """
+    merges_to_shift = [mr for mr in ws.merged_cells.ranges if mr.min_row >= idx]
+    for mr in merges_to_shift:
+        ws.merged_cells.remove(mr)
+    ws.insert_rows(idx, amount=amount)
+    for mr in merges_to_shift:
+        mr.shift(row_shift=amount)
+        ws.merged_cells.add(mr)
+
+def expand_items_table(ws, template_row, n, max_row=None, max_col=None):
+    """
+    Expand the items table to accommodate n rows.
+    
+    max_row/max_col may be passed when the caller already knows the sheet
+    bounds (each ws.max_row / ws.max_column access recomputes them).
+    """
+    if max_row is None:
+        max_row = ws.max_row
+    if max_col is None:
+        max_col = ws.max_column
+    template_cells = next(ws.iter_rows(min_row=template_row, max_row=template_row, max_col=max_col))
+    # The new rows share the template cells' StyleArray objects instead of one copy
+    # per cell; table cells are only given values after expansion, never restyled
+    row_style = [cell._style if cell.has_style else None for cell in template_cells]
     row_height = ws.row_dimensions[template_row].height
     add_rows = max(0, n - 1)
     
-    # Handle merged cells
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
+    # Locate the Total row while it still sits right under the template row;
+    # after the insert it simply moves down by add_rows
+    total_header_row = None
+    column_a = ws.iter_rows(min_row=template_row + 1, max_row=max_row, max_col=1, values_only=True)
+    for offset, (value,) in enumerate(column_a, start=1):
+        if value == "Total":
+            total_header_row = template_row + offset
+            break
     
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
+    if total_header_row is None:
+        raise ValueError("Total row not found")
+    total_header_row += add_rows
     
     # Insert rows
     if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = template_row + offset
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
+        insert_rows_keeping_merges(ws, template_row + 1, add_rows)
+        new_rows = ws.iter_rows(min_row=template_row + 1, max_row=template_row + add_rows, max_col=max_col)
+        for row_cells in new_rows:
+            for dst, st in zip(row_cells, row_style):
                 dst.value = None
-                st = row_style[col - 1]
                 if st is not None:
-                    dst._style = style_copy(st)
+                    dst._style = st
             if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
+                ws.row_dimensions[row_cells[0].row].height = row_height
     
     # Update total formulas
-    total_header_row = None
-    for r in range(template_row + 1, ws.max_row + 1):
-        if ws.cell(row=r, column=1).value == "Total":
-            total_header_row = r
-            break
-    
-    if total_header_row is None:
-        raise ValueError("Total row not found")
-    
     first_data_row = template_row
     last_data_row = template_row + n - 1
     ws[f"H{total_header_row}"] = f"=SUM(H{first_data_row}:H{last_data_row})"
     ws[f"J{total_header_row}"] = f"=SUM(J{first_data_row}:J{last_data_row})"
     ws[f"K{total_header_row}"] = f"=COUNTA(K{first_data_row}:K{last_data_row})"
 
+# Salesforce connection được tạo một lần và dùng lại giữa các request
+_SF = None
+_SF_LOCK = threading.Lock()
+
 def get_salesforce_connection():
+    """Return the shared Salesforce connection, logging in on first use"""
+    global _SF
+    if _SF is not None:
+        return _SF
+    with _SF_LOCK:
+        if _SF is None:
+            _SF = _create_salesforce_connection()
+        return _SF
+
+def reset_salesforce_connection():
+    """Drop the shared connection so the next call re-authenticates"""
+    global _SF
+    with _SF_LOCK:
+        _SF = None
+
+def run_with_salesforce_session(func, *args, **kwargs):
+    """Run func, re-authenticating and retrying once if the Salesforce session expired"""
+    try:
+        return func(*args, **kwargs)
+    except SalesforceExpiredSession:
+        print("⚠ Salesforce session expired, re-authenticating")
+        reset_salesforce_connection()
+        return func(*args, **kwargs)
+
+def _create_salesforce_connection():
     """Initialize Salesforce connection"""
     username = os.getenv('SALESFORCE_USERNAME')
     password = os.getenv('SALESFORCE_PASSWORD')
@@ -140,50 +207,122 @@ def get_salesforce_connection():
         consumer_secret=consumer_secret
     )
 
-def get_picklist_values(sf, object_name: str, field_name: str) -> list[str]:
+# Describe/picklist cache: sobject describe() là một REST round trip đầy đủ,
+# metadata gần như không đổi nên giữ lại theo process (picklist có TTL).
+_DESCRIBE_CACHE = {}
+_PICKLIST_CACHE = {}
+_PICKLIST_LOCK = threading.Lock()
+PICKLIST_CACHE_TTL = 600  # seconds
+
+def describe_sobject(sf, object_name: str) -> dict:
+    """Return the describe() result of a Salesforce object, cached for PICKLIST_CACHE_TTL"""
+    cached = _DESCRIBE_CACHE.get(object_name)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    description = getattr(sf, object_name).describe()
+    _DESCRIBE_CACHE[object_name] = (time.monotonic() + PICKLIST_CACHE_TTL, description)
+    return description
+
+def cached_picklist_values(fetch, object_name: str, field_name: str) -> list[str]:
+    """Return picklist values for (object, field) from a TTL cache, calling fetch() on a miss"""
+    key = (object_name, field_name)
+    cached = _PICKLIST_CACHE.get(key)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    # Only one thread refreshes a key; concurrent callers (e.g. /health probes)
+    # wait for it and reuse the result instead of each running a describe
+    with _PICKLIST_LOCK:
+        cached = _PICKLIST_CACHE.get(key)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        values = fetch()
+        if values:
+            _PICKLIST_CACHE[key] = (time.monotonic() + PICKLIST_CACHE_TTL, values)
+        return values
+
+SF_ID_RE = re.compile(r"^[a-zA-Z0-9]{15,18}$")
+
+def validate_sf_id(record_id: str) -> str:
+    """
+    Validate a Salesforce record Id before it is interpolated into SOQL.
+    
+    Raises:
+        ValueError: if the value is not a 15/18 character alphanumeric Id
+    """
+    if not record_id or not SF_ID_RE.match(record_id):
+        raise ValueError(f"Invalid Salesforce ID: {record_id}")
+    return record_id
+
+def get_child_records(sf, record, relationship_name: str) -> list:
     """
-    Get picklist values dynamically from Salesforce for any object and field.
+    Return all child records of a parent-to-child subquery on a queried record.
+    
+    Subquery results are paged like normal queries, so follow nextRecordsUrl
+    until the relationship is fully loaded.
+    """
+    child = record.get(relationship_name)
+    if not child:
+        return []
+    records = list(child['records'])
+    while not child.get('done', True):
+        child = sf.query_more(child['nextRecordsUrl'], identifier_is_url=True)
+        records.extend(child['records'])
+    return records
+
+def upload_content_version(sf, file_name: str, file_data, parent_id: str) -> dict:
+    """
+    Upload a generated file to Salesforce as a ContentVersion linked to parent_id.
+    
+    Uses the REST multipart form (entity_content JSON + binary VersionData part)
+    so the file goes over the wire as raw bytes instead of a base64 string.
     
     Args:
         sf: Salesforce connection instance
-        object_name: API name of the Salesforce object (e.g., 'Shipment__c')
-        field_name: API name of the picklist field (e.g., 'Freight__c')
+        file_name: Name of the file (Title is the name without extension)
+        file_data: bytes or a binary file object
+        parent_id: Record Id used as FirstPublishLocationId
     
     Returns:
-        List of picklist option values
+        The create response, e.g. {'id': ..., 'success': True, 'errors': []}
     """
-    try:
-        sobject = getattr(sf, object_name)
-        description = sobject.describe()
-        
-        for field in description['fields']:
-            if field['name'] == field_name:
-                if field['type'] == 'picklist' or field['type'] == 'multipicklist':
-                    return [option['value'] for option in field['picklistValues'] if option['active']]
-                else:
-                    print(f"⚠ Warning: {field_name} is not a picklist field (type: {field['type']})")
-                    return []
-        
-        print(f"⚠ Warning: {field_name} field not found on {object_name}")
-        return []
-    except Exception as e:
-        print(f"⚠ Warning: Could not fetch picklist values for {object_name}.{field_name}: {e}")
-        return []
+    url = f"{sf.base_url}sobjects/ContentVersion/"
+    entity = {
+        "Title": file_name.rsplit(".", 1)[0],
+        "PathOnClient": file_name,
+        "FirstPublishLocationId": parent_id,
+    }
+    files = {
+        "entity_content": (None, json.dumps(entity), "application/json"),
+        "VersionData": (file_name, file_data, "application/octet-stream"),
+    }
+    resp = sf.session.post(
+        url,
+        headers={"Authorization": f"Bearer {sf.session_id}"},
+        files=files,
+        timeout=120,
+    )
+    if resp.status_code == 401:
+        raise SalesforceExpiredSession(url, resp.status_code, "ContentVersion", resp.content)
+    resp.raise_for_status()
+    return resp.json()
+
+def is_serverless_environment() -> bool:
+    """Check if we're running on a serverless platform (Vercel, AWS Lambda)"""
+    return (
+        os.getenv('VERCEL') is not None or  # Vercel
+        os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None or  # AWS Lambda
+        os.getenv('LAMBDA_TASK_ROOT') is not None  # AWS Lambda alternative
+    )
 
+@lru_cache(maxsize=1)
 def get_output_directory() -> Path:
     """
     Get the appropriate output directory based on environment.
     Use /tmp for serverless environments (Vercel, AWS Lambda) where filesystem is read-only.
     Use ./output for local development.
+    Resolved (and created) once per process - the environment does not change.
     """
-    # Check if we're in a serverless environment
-    is_serverless = (
-        os.getenv('VERCEL') is not None or  # Vercel
-        os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None or  # AWS Lambda
-        os.getenv('LAMBDA_TASK_ROOT') is not None  # AWS Lambda alternative
-    )
-    
-    if is_serverless:
+    if is_serverless_environment():
         output_dir = Path("/tmp")
     else:
         output_dir = Path("output")
@@ -191,6 +330,92 @@ def get_output_directory() -> Path:
     
     return output_dir
 
+# Templates cached per process: ("pickle", blob) for parsed Workbook objects -
+# unpickling is several times cheaper than re-parsing the template XML - or
+# ("xlsx", bytes) for templates with embedded images, which gain nothing from
+# pickling and are re-parsed from memory instead of disk
+_TEMPLATE_CACHE = {}
+
+def load_template_workbook(template_path):
+    """
+    Return a fresh, independent Workbook for template_path.
+    
+    The template is read from disk once per process (and again only when its
+    mtime changes); each call builds a new copy, so callers may modify the
+    returned workbook freely.
+    """
+    key = str(template_path)
+    mtime = os.stat(template_path).st_mtime_ns
+    cached = _TEMPLATE_CACHE.get(key)
+    if cached is None or cached[0] != mtime:
+        with open(template_path, "rb") as f:
+            raw = f.read()
+        wb = openpyxl.load_workbook(io.BytesIO(raw), keep_links=False)
+        if any(ws._images for ws in wb.worksheets):
+            _TEMPLATE_CACHE[key] = (mtime, "xlsx", raw)
+            return wb
+        cached = (mtime, "pickle", pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL))
+        _TEMPLATE_CACHE[key] = cached
+    _, kind, blob = cached
+    if kind == "xlsx":
+        return openpyxl.load_workbook(io.BytesIO(blob), keep_links=False)
+    wb = pickle.loads(blob)
+    # DimensionHolder (a defaultdict subclass) loses its factory when unpickled,
+    # so row_dimensions[r] / column_dimensions[c] would raise KeyError for
+    # rows and columns the template never sized
+    for ws in wb.worksheets:
+        ws.row_dimensions.worksheet = ws
+        ws.row_dimensions.default_factory = ws._add_row
+        ws.column_dimensions.worksheet = ws
+        ws.column_dimensions.default_factory = ws._add_column
+    return wb
+
+_TEMPLATE_MARKERS = {}
+
+def template_marker_coord(template_path, sheet_name, marker):
+    """
+    Return (row, column) of the first cell on sheet_name containing marker, or None.
+    
+    Templates are static, so each sheet is scanned once per template version
+    (read-only, values only) and later requests go straight to the cell.
+    """
+    key = (str(template_path), os.stat(template_path).st_mtime_ns, sheet_name, marker)
+    if key not in _TEMPLATE_MARKERS:
+        coord = None
+        wb = openpyxl.load_workbook(template_path, read_only=True)
+        try:
+            for row_idx, row in enumerate(wb[sheet_name].iter_rows(values_only=True), start=1):
+                for col_idx, value in enumerate(row, start=1):
+                    if isinstance(value, str) and marker in value:
+                        coord = (row_idx, col_idx)
+                        break
+                if coord:
+                    break
+        finally:
+            wb.close()
+        _TEMPLATE_MARKERS[key] = coord
+    return _TEMPLATE_MARKERS[key]
+
+def save_workbook_bytes(wb, file_path: Path):
+    """
+    Save a workbook into memory and return (bytes, saved_path).
+    
+    The bytes are what gets uploaded to Salesforce; a local copy is only
+    written outside serverless environments (saved_path is None otherwise).
+    """
+    serverless = is_serverless_environment()
+    buf = io.BytesIO()
+    # Same as wb.save(buf), but on serverless deflate at level 1: CPU time is
+    # billed there and the files are only slightly larger
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, allowZip64=True,
+                              compresslevel=1 if serverless else None)
+    ExcelWriter(wb, archive).save()
+    data = buf.getvalue()
+    if serverless:
+        return data, None
+    file_path.write_bytes(data)
+    return data, file_path
+
 def sanitize_filename(filename):
     """
     Sanitize the filename by removing or replacing invalid characters.
@@ -201,6 +426,40 @@ def sanitize_filename(filename):
     return re.sub(r'[\\/*?:"<>|]', '_', str(filename)).strip()
 
 
+# Whole-cell numeric placeholder, e.g. "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}"
+NUMBER_FORMAT_PLACEHOLDER_RE = re.compile(r"\{\{([\w.]+)\\#\s*([^{}]+)\}\}")
+
+def split_number_format_placeholders(replacements):
+    """
+    Pop the "{{field\\# fmt}}" placeholders out of `replacements`.
+    
+    Returns {placeholder: (value, number_format)} so those cells can be written
+    as real numbers instead of stringified values.
+    """
+    numeric = {}
+    for placeholder in list(replacements):
+        match = NUMBER_FORMAT_PLACEHOLDER_RE.fullmatch(placeholder)
+        if match:
+            numeric[placeholder] = (replacements.pop(placeholder), match.group(2).strip())
+    return numeric
+
+@lru_cache(maxsize=32)
+def _placeholder_regex(keys):
+    """Alternation of the literal placeholders, longest first so none shadows another"""
+    return re.compile('|'.join(map(re.escape, sorted(keys, key=len, reverse=True))))
+
+def compile_placeholder_pattern(substitutions):
+    """
+    Compile a dict of literal placeholder -> replacement text into one regex.
+    
+    Returns a function that replaces every placeholder of a string in a single
+    scan, instead of one str.replace per placeholder per cell. The placeholder
+    set is fixed per document type, so the compiled regex is reused across
+    requests and only the replacement values change.
+    """
+    pattern = _placeholder_regex(frozenset(substitutions))
+    return lambda text: pattern.sub(lambda m: substitutions[m.group(0)], text)
+
 def format_picklist_checkboxes(options, selected_value, uppercase=False):
     """
     Format picklist options as a checkbox list.
@@ -228,6 +487,7 @@ def format_picklist_checkboxes(options, selected_value, uppercase=False):
 
 def generate_packing_list(shipment_id: str, template_path: str):
     """Generate packing list for a given shipment ID"""
+    validate_sf_id(shipment_id)
     
     # Connect to Salesforce
     sf = get_salesforce_connection()
@@ -235,56 +495,39 @@ def generate_packing_list(shipment_id: str, template_path: str):
     # Get freight options dynamically from Salesforce
     freight_options = get_picklist_values(sf, 'Shipment__c', 'Freight__c')
     
-    # Query shipment data
-    shipment_query = f"""
+    # Query shipment + consignee + bookings + container items in one round trip
+    shipment_query = """
     SELECT Name, Consignee__c, Invoice_Packing_list_no__c, Issued_date__c, Port_of_Origin__c,
     Final_Destination__c, Stockyard__c, Ocean_Vessel__c, B_L_No__c, Freight__c,
     Departure_Date_ETD__c, Arrival_Schedule_ETA__c, Remark_number_on_documents__c,
-    Terms_of_Sales__c, Terms_of_Payment__c
+    Terms_of_Sales__c, Terms_of_Payment__c,
+    Consignee__r.Name, Consignee__r.BillingStreet, Consignee__r.BillingCity,
+    Consignee__r.BillingPostalCode, Consignee__r.BillingCountry,
+    Consignee__r.Phone, Consignee__r.Fax__c, Consignee__r.VAT__c,
+    (SELECT Cont_Quantity__c FROM Bookings__r),
+    (SELECT Line_item_no_for_print__c, Product_Description__c, Length__c, Width__c, Height__c,
+     Quantity_For_print__c, Unit_for_print__c, Crates__c, Packing__c, Order_No__c,
+     Container__r.Name, Container__r.Container_Weight_Regulation__c
+     FROM Container_Items__r)
     FROM Shipment__c
-    WHERE Id = '{shipment_id}'
+    WHERE Id = {shipment_id}
     """
-    shipment_result = sf.query(shipment_query)
+    shipment_result = sf.query(format_soql(shipment_query, shipment_id=shipment_id))
     if not shipment_result['records']:
         raise ValueError(f"No Shipment found with ID: {shipment_id}")
     shipment = shipment_result['records'][0]
     
-    # Query account/consignee data
-    if shipment['Consignee__c']:
-        account_query = f"""
-        SELECT Name, BillingStreet, BillingCity, BillingPostalCode, BillingCountry,
-        Phone, Fax__c, VAT__c
-        FROM Account
-        WHERE Id = '{shipment['Consignee__c']}'
-        """
-        account_result = sf.query(account_query)
-        account = account_result['records'][0] if account_result['records'] else {}
-    else:
-        account = {}
+    account = (shipment.get('Consignee__r') or {}) if shipment['Consignee__c'] else {}
     
-    # Query bookings
-    bookings_query = f"""
-    SELECT Id, Cont_Quantity__c
-    FROM Booking__c
-    WHERE Shipment__c = '{shipment_id}'
-    """
-    bookings_result = sf.query_all(bookings_query)
-    bookings = bookings_result['records']
-    total_containers_from_bookings = sum(booking.get('Cont_Quantity__c') or 0 for booking in bookings)
+    bookings = get_child_records(sf, shipment, 'Bookings__r')
+    total_containers_from_bookings = sum(filter(None, map(itemgetter('Cont_Quantity__c'), bookings)))
     
-    # Query container items
-    items_query = f"""
-    SELECT Line_item_no_for_print__c, Product_Description__c, Length__c, Width__c, Height__c,
-    Quantity_For_print__c, Unit_for_print__c, Crates__c, Packing__c, Order_No__c,
-    Container__r.Name, Container__r.Container_Weight_Regulation__c
-    FROM Container_Item__c
-    WHERE Shipment__c = '{shipment_id}'
-    """
-    items_result = sf.query_all(items_query)
-    items = items_result['records']
+    items = get_child_records(sf, shipment, 'Container_Items__r')
     
-    # Load template
-    wb = openpyxl.load_workbook(template_path)
+    # Load template. write_only/streaming mode cannot keep the template's styles,
+    # merged ranges and Total formulas, so stay in normal mode (parsed once, see
+    # load_template_workbook)
+    wb = load_template_workbook(template_path)
     ws = wb['PackingList']
     
     # Replace placeholders (excluding Freight__c as it needs special handling)
@@ -311,20 +554,6 @@ def generate_packing_list(shipment_id: str, template_path: str):
         '{{Shipment__c.Terms_of_Payment__c}}': shipment.get('Terms_of_Payment__c') or '',
     }
     
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                for placeholder, value in replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-                if '{{TableStart:Shipment__c.r.Bookings__r}}' in cell.value:
-                    cell.value = str(total_containers_from_bookings)
-    
-    # Remove "None" values
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str) and 'None' in cell.value:
-                cell.value = cell.value.replace('None', '')
-    
     # Handle freight checkboxes dynamically
     checked_box = '☑'
     unchecked_box = '☐'
@@ -340,34 +569,39 @@ def generate_packing_list(shipment_id: str, template_path: str):
     
     checkbox_text = "\n".join(lines)
     
-    # Replace freight placeholder with checkbox text
-    # for row in ws.iter_rows():
-    #     for cell in row:
-    #         if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-    #             cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
+    # One pass over the sheet: placeholders, freight checkboxes and the
+    # ContainerItems table marker (missing values become "", never "None")
+    substitutions = {
+        placeholder: "" if value is None else str(value)
+        for placeholder, value in replacements.items()
+    }
+    substitutions['{{Shipment__c.Freight__c}}'] = checkbox_text
+    fill_placeholders = compile_placeholder_pattern(substitutions)
     
+    # Bookings total replaces its marker cell, found once per template version
+    bookings_coord = template_marker_coord(template_path, ws.title, '{{TableStart:Shipment__c.r.Bookings__r}}')
+    if bookings_coord:
+        ws.cell(*bookings_coord).value = str(total_containers_from_bookings)
+    
+    table_start_row = None
     for row in ws.iter_rows():
         for cell in row:
-            if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-                cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
+            value = cell.value
+            if not value or not isinstance(value, str):
+                continue
+            if table_start_row is None and cell.column <= 13 and '{{TableStart:ContainerItems}}' in value:
+                table_start_row = cell.row
+            new_value = fill_placeholders(value)
+            if new_value != value:
+                cell.value = new_value
+            if '{{Shipment__c.Freight__c}}' in value:
                 if cell.alignment:
                     new_alignment = style_copy(cell.alignment)
                 else:
-                    from openpyxl.styles import Alignment
                     new_alignment = Alignment()
                 new_alignment.wrap_text = True
                 cell.alignment = new_alignment
     
-    # Find table start row
-    table_start_row = None
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=13):
-        for cell in row:
-            if cell.value and '{{TableStart:ContainerItems}}' in str(cell.value):
-                table_start_row = cell.row
-                break
-        if table_start_row:
-            break
-    
     if not table_start_row:
         raise ValueError("No table start marker found in template")
     
@@ -375,48 +609,43 @@ def generate_packing_list(shipment_id: str, template_path: str):
     expand_items_table(ws, table_start_row, len(items) if items else 1)
     
     # Fill in item data
-    for idx, item in enumerate(items):
-        row = table_start_row + idx
-        container_r = item.get('Container__r', {})
-        line_item_no = item.get('Line_item_no_for_print__c') or str(idx + 1)
-        ws.cell(row, 1).value = line_item_no
-        ws.cell(row, 2).value = item.get('Product_Description__c')
-        ws.cell(row, 3).value = item.get('Length__c')
-        ws.cell(row, 4).value = item.get('Width__c')
-        ws.cell(row, 5).value = item.get('Height__c')
-        ws.cell(row, 6).value = item.get('Quantity_For_print__c') or ''
-        ws.cell(row, 7).value = item.get('Unit_for_print__c') or ''
-        ws.cell(row, 8).value = item.get('Crates__c')
-        ws.cell(row, 9).value = f"{item.get('Packing__c') or ''} pcs/crate"
-        ws.cell(row, 10).value = container_r.get('Container_Weight_Regulation__c')
-        ws.cell(row, 11).value = container_r.get('Name')
-        ws.cell(row, 13).value = item.get('Order_No__c')
+    item_rows = ws.iter_rows(min_row=table_start_row, max_row=table_start_row + len(items) - 1, max_col=13)
+    # SOQL records always carry every selected field, so fetch them as one tuple per item
+    item_fields = itemgetter(
+        'Line_item_no_for_print__c', 'Product_Description__c', 'Length__c', 'Width__c', 'Height__c',
+        'Quantity_For_print__c', 'Unit_for_print__c', 'Crates__c', 'Packing__c', 'Order_No__c', 'Container__r'
+    )
+    for idx, (fields, row_cells) in enumerate(zip(map(item_fields, items), item_rows)):
+        line_item_no, desc, length, width, height, qty, unit, crates, packing, order_no, container_r = fields
+        container_r = container_r or {}
+        row_cells[0].value = line_item_no or str(idx + 1)
+        row_cells[1].value = desc
+        row_cells[2].value = length
+        row_cells[3].value = width
+        row_cells[4].value = height
+        row_cells[5].value = qty or ''
+        row_cells[6].value = unit or ''
+        row_cells[7].value = crates
+        row_cells[8].value = f"{packing or ''} pcs/crate"
+        row_cells[9].value = container_r.get('Container_Weight_Regulation__c')
+        row_cells[10].value = container_r.get('Name')
+        row_cells[12].value = order_no
     
     # Save file
-    now = datetime.datetime.now()
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
     file_name = f"Packing_List_{shipment.get('Invoice_Packing_list_no__c', shipment['Name'])}_{timestamp}.xlsx"
     
     # Use appropriate output directory based on environment
     output_dir = get_output_directory()
     file_path = output_dir / file_name
     
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": shipment_id
-    })
+    content_version = upload_content_version(sf, file_name, data, shipment_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version['id'],
         "freight_options_used": freight_options
@@ -443,8 +672,9 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test Salesforce connection
-        sf = get_salesforce_connection()
-        freight_options = get_picklist_values(sf, 'Shipment__c', 'Freight__c')
+        def fetch_freight_options():
+            return get_picklist_values(get_salesforce_connection(), 'Shipment__c', 'Freight__c')
+        freight_options = await asyncio.to_thread(run_with_salesforce_session, fetch_freight_options)
         return {
             "status": "healthy",
             "salesforce_connected": True,
@@ -471,7 +701,7 @@ async def generate_packing_list_get(shipment_id: str):
                 detail=f"Template file not found at: {template_path}"
             )
         
-        result = generate_packing_list(shipment_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_packing_list, shipment_id, template_path)
         
         return {
             "status": "success",
@@ -501,7 +731,7 @@ async def generate_packing_list_post(request: ShipmentRequest):
                 detail=f"Template file not found at: {template_path}"
             )
         
-        result = generate_packing_list(request.shipment_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_packing_list, request.shipment_id, template_path)
         
         return {
             "status": "success",
@@ -516,28 +746,46 @@ async def generate_packing_list_post(request: ShipmentRequest):
 
 # ================= HELPERS BASE.VN =================
 
+# HTML of rich text Salesforce fields, one alternative per replacement:
+# line-breaking tag (group 1), list item (group 2), any other tag
+HTML_TAG_RE = re.compile(r'<(br\s*/?|/p|/div|/tr)>|(<li.*?>)|<[^>]+>', re.IGNORECASE)
+
+def replace_html_tag(match):
+    if match.group(1) is not None:
+        return '\n'
+    if match.group(2) is not None:
+        return '\n- '
+    return ''
+
 def convert_html_to_richtext(raw_html):
     if not raw_html: return ""
-    text = re.sub(r'<(br\s*/?|/p|/div|/tr)>', '\n', raw_html, flags=re.IGNORECASE)
-    text = re.sub(r'<li.*?>', '\n- ', text, flags=re.IGNORECASE)
-    text = re.sub(r'<[^>]+>', '', text)
-    text = html.unescape(text)
-    return '\n'.join([line.strip() for line in text.split('\n') if line.strip()])
+    # Plain text (no tags, no entities): skip the regex pass and unescape
+    if '<' not in raw_html and '&' not in raw_html:
+        text = raw_html
+    else:
+        text = html.unescape(HTML_TAG_RE.sub(replace_html_tag, raw_html))
+    return '\n'.join(filter(None, map(str.strip, text.split('\n'))))
 
 def format_date_base(iso_date_str):
     if not iso_date_str: return ""
-    try:
-        # Assuming iso_date_str is YYYY-MM-DD...
-        date_obj = datetime.datetime.strptime(iso_date_str[:10], "%Y-%m-%d")
-        return date_obj.strftime("%d/%m/%Y")
-    except: return iso_date_str
+    # Salesforce dates/datetimes start with a zero-padded YYYY-MM-DD: rearrange
+    # the slices instead of a strptime/strftime round trip
+    y, m, d = iso_date_str[0:4], iso_date_str[5:7], iso_date_str[8:10]
+    if iso_date_str[4:5] == '-' == iso_date_str[7:8] and (y + m + d).isdigit() and len(y + m + d) == 8:
+        return f"{d}/{m}/{y}"
+    return iso_date_str
+
+# File đính kèm lấy luôn qua subquery ContentDocumentLinks: một round trip thay vì hai
+CASE_SYNC_SOQL = "SELECT Id, Subject, Customer_Complain_Content__c, So_LSX__c, Date_Export__c, Number_Container__c, CreatedDate, Account.Account_Code__c, (SELECT ContentDocument.Title, ContentDocument.FileExtension, ContentDocument.LatestPublishedVersionId FROM ContentDocumentLinks) FROM Case WHERE Id = {case_id}"
 
 def get_sf_data(sf, case_id):
+    """Return (Base.vn field data, ContentDocumentLink records) of a Case, or (None, [])"""
+    validate_sf_id(case_id)
     print(f"--- [SF] Lấy dữ liệu Case {case_id} ---")
-    query = f"SELECT Id, Subject, Customer_Complain_Content__c, So_LSX__c, Date_Export__c, Number_Container__c, CreatedDate, Account.Account_Code__c FROM Case WHERE Id = '{case_id}'"
-    res = sf.query(query)
-    if not res['records']: return None
+    res = sf.query(format_soql(CASE_SYNC_SOQL, case_id=case_id))
+    if not res['records']: return None, []
     rec = res['records'][0]
+    links = get_child_records(sf, rec, 'ContentDocumentLinks')
     return {
         KEYS['MA_KH']: rec.get('Account', {}).get('Account_Code__c', ''),
         KEYS['NGAY_PHAN_ANH']: format_date_base(rec.get('CreatedDate')),
@@ -546,35 +794,87 @@ def get_sf_data(sf, case_id):
         KEYS['SO_CONT']: rec.get('Number_Container__c', ''),
         KEYS['LSX']: rec.get('So_LSX__c', ''),
         "subject": rec.get('Subject', 'No Subject')
-    }
+    }, links
+
+class SizedUpload:
+    """
+    A downloaded attachment with its byte count, as a MultipartEncoder file part.
+    
+    The encoder sizes file parts through .len (bytes left to read); without it it
+    calls fileno(), which rolls a SpooledTemporaryFile over to disk.
+    """
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.len = size
 
-def download_sf_files(sf, case_id):
-    files_payload = []
-    q = f"SELECT ContentDocument.Title, ContentDocument.FileExtension, ContentDocument.LatestPublishedVersionId FROM ContentDocumentLink WHERE LinkedEntityId = '{case_id}'"
-    res = sf.query(q)
-    for rec in res['records']:
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        self.len -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.fileobj.close()
+
+def download_sf_files(sf, links):
+    """Download the files of ContentDocumentLink records as Base.vn root_file[] parts"""
+    headers = {"Authorization": f"Bearer {sf.session_id}"}
+
+    def fetch(rec):
         ver_id = rec['ContentDocument']['LatestPublishedVersionId']
         fname = f"{rec['ContentDocument']['Title']}.{rec['ContentDocument']['FileExtension']}"
         d_url = f"https://{sf.sf_instance}/services/data/v52.0/sobjects/ContentVersion/{ver_id}/VersionData"
-        r = requests.get(d_url, headers={"Authorization": f"Bearer {sf.session_id}"}, stream=True)
-        if r.status_code == 200:
-            files_payload.append(('root_file[]', (fname, io.BytesIO(r.content), 'application/octet-stream')))
-    return files_payload
+        # The with block releases the pooled connection, also for non-200 responses
+        with sf.session.get(d_url, headers=headers, stream=True, timeout=120) as r:
+            if r.status_code != 200:
+                return None
+            # Stream the body: attachments up to 1 MB stay in memory, larger
+            # ones spill to a temp file instead of being held as one bytes object
+            buf = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+            size = 0
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                size += buf.write(chunk)
+            buf.seek(0)
+            return ('root_file[]', (fname, SizedUpload(buf, size), 'application/octet-stream'))
+
+    # Each attachment is an independent round trip: download them concurrently,
+    # over the Salesforce connection's pooled session (keep-alive)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        downloads = list(executor.map(fetch, links))
+    return [f for f in downloads if f is not None]
+
+# Ticket index của Base.vn: tên phiếu (đã strip) -> id, giữ theo process có TTL.
+# Tra trúng thì không cần gọi get.all; trượt (hoặc hết hạn) thì tải lại, vì phiếu
+# có thể vừa được tạo bên Base.vn.
+_BASE_TICKET_INDEX = {}
+_BASE_TICKET_LOCK = threading.Lock()
+BASE_TICKET_INDEX_TTL = 60  # seconds
+
+def load_base_ticket_index():
+    """Fetch all tickets of the Base.vn service as {stripped name: id} (first ticket wins)"""
+    resp = BASE_SESSION.post(URL_GET_ALL, data={"access_token_v2": SERVICE_ACCESS_TOKEN, "service_id": BASE_SERVICE_ID}, timeout=BASE_TIMEOUT)
+    index = {}
+    for t in orjson.loads(resp.content).get('tickets', []):
+        index.setdefault((t.get('name') or '').strip(), t.get('id'))
+    return index
 
 def find_ticket_id(subject):
-    resp = requests.post(URL_GET_ALL, data={"access_token_v2": os.getenv("SERVICE_ACCESS_TOKEN"), "service_id": BASE_SERVICE_ID})
-    try:
-        data = resp.json()
-        for t in data.get('tickets', []):
-            if t.get('name', '').strip() == subject.strip(): return t.get('id')
-    except Exception as e:
-        print(f"Error finding ticket: {e}")
-    return None
+    key = subject.strip()
+    cached = _BASE_TICKET_INDEX.get('tickets')
+    if cached and time.monotonic() < cached[0] and key in cached[1]:
+        return cached[1][key]
+    with _BASE_TICKET_LOCK:
+        try:
+            index = load_base_ticket_index()
+        except Exception as e:
+            print(f"Error finding ticket: {e}")
+            return None
+        _BASE_TICKET_INDEX['tickets'] = (time.monotonic() + BASE_TICKET_INDEX_TTL, index)
+    return index.get(key)
 
 def create_ticket(subject, sf_data):
     print("--- [BASE] Tạo phiếu mới ---")
     payload = {
-        "access_token_v2": os.getenv("SERVICE_ACCESS_TOKEN"),
+        "access_token_v2": SERVICE_ACCESS_TOKEN,
         "service_id": BASE_SERVICE_ID,
         "block_id": BASE_BLOCK_ID_CREATE,
         "username": BASE_USERNAME,
@@ -582,27 +882,37 @@ def create_ticket(subject, sf_data):
     }
     # Tối ưu: Update thẳng data vào payload Create, không cần custom_field_ids
     payload.update({k: v for k, v in sf_data.items() if k != 'subject'})
-    resp = requests.post(URL_CREATE, data=payload)
-    return resp.json().get('data', {}).get('id')
+    resp = BASE_SESSION.post(URL_CREATE, data=payload, timeout=BASE_TIMEOUT)
+    ticket_id = orjson.loads(resp.content).get('data', {}).get('id')
+    # Phiếu mới vào index luôn, lần đồng bộ sau trong TTL không phải tải lại
+    cached = _BASE_TICKET_INDEX.get('tickets')
+    if ticket_id and cached:
+        cached[1][subject.strip()] = ticket_id
+    return ticket_id
 
 def update_smart(ticket_id, sf_data, files):
     print(f"--- [BASE] Kiểm tra đồng bộ Ticket {ticket_id} ---")
-    detail = requests.post(URL_GET_DETAIL, data={"access_token_v2": os.getenv("SERVICE_ACCESS_TOKEN"), "id": ticket_id}).json()
+    detail_resp = BASE_SESSION.post(URL_GET_DETAIL, data={"access_token_v2": SERVICE_ACCESS_TOKEN, "id": ticket_id}, timeout=BASE_TIMEOUT)
+    detail = orjson.loads(detail_resp.content)
     ticket = detail.get('tickets', [{}])[0]
     
     # 1. So sánh Field
-    current_fields = {f['key']: str(f.get('value', '')).strip() for f in ticket.get('custom_object', [])}
+    # Chỉ strip các field có trong sf_data - ticket có thể có nhiều custom field khác
+    wanted = set(sf_data) - {'subject'}
+    current_fields = {f['key']: str(f.get('value', '')).strip() for f in ticket.get('custom_object', []) if f['key'] in wanted}
     fields_to_up = {}
     for k, v in sf_data.items():
-        if k == 'subject': continue
+        if k not in wanted: continue
         target = str(v or '').strip()
         if current_fields.get(k) != target:
             fields_to_up[k] = target
 
     # 2. So sánh File
-    existing_files = {f.get('name') for f in ticket.get('files', [])}
-    if 'root_export' in ticket:
-        existing_files.update({f.get('name') for f in ticket['root_export'].get('files', [])})
+    existing_files = {
+        f.get('name')
+        for src in (ticket.get('files', []), ticket.get('root_export', {}).get('files', []))
+        for f in src
+    }
     
     files_to_up = [f for f in files if f[1][0] not in existing_files]
 
@@ -612,14 +922,19 @@ def update_smart(ticket_id, sf_data, files):
 
     # 3. Gửi Update: Bắt buộc kèm custom_field_ids
     payload = {
-        "access_token_v2": os.getenv("SERVICE_ACCESS_TOKEN"),
+        "access_token_v2": SERVICE_ACCESS_TOKEN,
         "service_id": BASE_SERVICE_ID,
         "ticket_id": ticket_id,
         "username": BASE_USERNAME,
         "custom_field_ids": ",".join(fields_to_up.keys())
     }
     payload.update(fields_to_up)
-    resp = requests.post(URL_EDIT_CUSTOM, data=payload, files=files_to_up if files_to_up else None)
+    if files_to_up:
+        # MultipartEncoder đọc file theo từng chunk khi gửi, thay vì dựng toàn bộ body trong RAM
+        enc = MultipartEncoder(fields=[(k, str(v)) for k, v in payload.items()] + files_to_up)
+        resp = BASE_SESSION.post(URL_EDIT_CUSTOM, data=enc, headers={"Content-Type": enc.content_type}, timeout=BASE_TIMEOUT)
+    else:
+        resp = BASE_SESSION.post(URL_EDIT_CUSTOM, data=payload, timeout=BASE_TIMEOUT)
     print(f"   -> Kết quả: {resp.status_code}")
 
 @app.get("/sync-base-service")
@@ -627,26 +942,34 @@ async def sync_base_service(case_id: str = SF_CASE_ID_DEFAULT):
     """
     Sync logic from Salesforce Case to Base.vn Ticket
     """
+    if not SF_ID_RE.match(case_id):
+        raise HTTPException(status_code=400, detail=f"Invalid Salesforce ID: {case_id}")
     try:
-        sf = get_salesforce_connection()
-        data = get_sf_data(sf, case_id)
+        def load_case():
+            sf = get_salesforce_connection()
+            return (sf, *get_sf_data(sf, case_id))
+        sf, data, links = await asyncio.to_thread(run_with_salesforce_session, load_case)
         if not data:
             return {"status": "error", "message": "Case không tồn tại."}
         
-        files = download_sf_files(sf, case_id)
-        t_id = find_ticket_id(data['subject'])
-        
-        action = "none"
-        if not t_id:
-            t_id = create_ticket(data['subject'], data)
-            action = "created"
+        # Salesforce downloads and the Base.vn ticket lookup are independent
+        files, t_id = await asyncio.gather(
+            asyncio.to_thread(download_sf_files, sf, links),
+            asyncio.to_thread(find_ticket_id, data['subject']),
+        )
         
-        if t_id:
-            update_smart(t_id, data, files)
-            if action == "none": action = "checked/updated"
-
-        # Close files
-        for _, f in files: f[1].close()
+        try:
+            action = "none"
+            if not t_id:
+                t_id = create_ticket(data['subject'], data)
+                action = "created"
+            
+            if t_id:
+                update_smart(t_id, data, files)
+                if action == "none": action = "checked/updated"
+        finally:
+            # Close files (also when the Base.vn update fails)
+            for _, f in files: f[1].close()
 
         return {
             "status": "success",
@@ -658,45 +981,29 @@ async def sync_base_service(case_id: str = SF_CASE_ID_DEFAULT):
         raise HTTPException(status_code=500, detail=f"Error syncing to Base.vn: {str(e)}")
 
 
-def expand_invoice_items_table(ws, template_row: int, n: int) -> None:
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=template_row, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
+def expand_invoice_items_table(ws, template_row: int, n: int, max_col: int = None) -> None:
+    if max_col is None:
+        max_col = ws.max_column
+    template_cells = next(ws.iter_rows(min_row=template_row, max_row=template_row, max_col=max_col))
+    # The new rows share the template cells' StyleArray objects instead of one copy
+    # per cell; table cells are only given values after expansion, never restyled
+    row_style = [cell._style if cell.has_style else None for cell in template_cells]
     row_height = ws.row_dimensions[template_row].height
     add_rows = max(0, n - 1)
 
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
     if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = template_row + offset
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
+        insert_rows_keeping_merges(ws, template_row + 1, add_rows)
+        new_rows = ws.iter_rows(min_row=template_row + 1, max_row=template_row + add_rows, max_col=max_col)
+        for row_cells in new_rows:
+            for dst, st in zip(row_cells, row_style):
                 dst.value = None
-                st = row_style[col - 1]
                 if st is not None:
-                    dst._style = style_copy(st)
+                    dst._style = st
             if row_height is not None:
-                ws.row_dimensions[r].height = row_height
+                ws.row_dimensions[row_cells[0].row].height = row_height
 
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-
-@app.get("/generate_invoice/{shipment_id}")
-def generate_invoice(shipment_id: str):
+def generate_invoice_file(shipment_id: str):
+    validate_sf_id(shipment_id)
     sf = get_salesforce_connection()
 
     # Base and discount templates
@@ -709,7 +1016,7 @@ def generate_invoice(shipment_id: str):
     terms_of_sales_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Sales__c')
     terms_of_payment_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Payment__c')
 
-    shipment_query = f"""
+    shipment_query = """
     SELECT Name, Consignee__c, Invoice_Packing_list_no__c, Issued_date__c,
            Port_of_Origin__c, Final_Destination__c, Stockyard__c,
            Ocean_Vessel__c, B_L_No__c, Freight__c,
@@ -718,11 +1025,26 @@ def generate_invoice(shipment_id: str):
            Terms_of_Sales__c, Terms_of_Payment__c,
            Subtotal_USD__c, Fumigation__c, In_words__c,
            Total_Price_USD__c, Surcharge_amount_USD__c,
-           Discount_Percentage__c, Discount_Amount__c
+           Discount_Percentage__c, Discount_Amount__c,
+           Consignee__r.Name, Consignee__r.BillingStreet, Consignee__r.BillingCity,
+           Consignee__r.BillingPostalCode, Consignee__r.BillingCountry,
+           Consignee__r.Phone, Consignee__r.Fax__c, Consignee__r.VAT__c,
+           (SELECT Line_item_no_for_print__c, Product_Description__c,
+                   Length__c, Width__c, Height__c,
+                   Quantity_For_print__c, Unit_for_print__c,
+                   Sales_Price_USD__c, Charge_Unit__c,
+                   Total_Price_USD__c, Order_No__c,
+                   Container__r.STT_Cont__c
+            FROM Container_Items__r
+            ORDER BY Line_item_no_for_print__c),
+           (SELECT Contract_PI__r.Name, Reconciled_Amount__c
+            FROM Receipt_Reconciliation__r),
+           (SELECT Reason, Refund_Amount__c
+            FROM Cases__r)
     FROM Shipment__c
-    WHERE Id = '{shipment_id}'
+    WHERE Id = {shipment_id}
     """
-    shipment_result = sf.query(shipment_query)
+    shipment_result = sf.query(format_soql(shipment_query, shipment_id=shipment_id))
     if not shipment_result["records"]:
         raise ValueError(f"No Shipment found with ID: {shipment_id}")
     shipment = shipment_result["records"][0]
@@ -740,52 +1062,18 @@ def generate_invoice(shipment_id: str):
     if discount_exists:
         template_path = discount_template_path
 
-    # Account / Consignee
-    if shipment.get("Consignee__c"):
-        account_query = f"""
-        SELECT Name, BillingStreet, BillingCity, BillingPostalCode, BillingCountry,
-               Phone, Fax__c, VAT__c
-        FROM Account
-        WHERE Id = '{shipment['Consignee__c']}'
-        """
-        account_result = sf.query(account_query)
-        account = account_result["records"][0] if account_result["records"] else {}
-    else:
-        account = {}
-
-    # Container items
-    items_query = f"""
-    SELECT Line_item_no_for_print__c, Product_Description__c,
-           Length__c, Width__c, Height__c,
-           Quantity_For_print__c, Unit_for_print__c,
-           Sales_Price_USD__c, Charge_Unit__c,
-           Total_Price_USD__c, Order_No__c,
-           Container__r.STT_Cont__c
-    FROM Container_Item__c
-    WHERE Shipment__c = '{shipment_id}'
-    ORDER BY Line_item_no_for_print__c
-    """
-    items_result = sf.query_all(items_query)
-    items = items_result["records"]
-
-    # 💡 FIXED: use existing fields only
-    deposit_query = f"""
-    SELECT Contract_PI__r.Name, Reconciled_Amount__c
-    FROM Receipt_Reconciliation__c
-    WHERE Invoice__c = '{shipment_id}'
-    """
-    deposits = sf.query_all(deposit_query)["records"]
-
-    refunds_query = f"""
-    SELECT Reason, Refund_Amount__c
-    FROM Case
-    WHERE Refund_in_Shipment__c = '{shipment_id}'
-    """
-    refunds = sf.query_all(refunds_query)["records"]
+    # Account / Consignee, container items, deposits and refunds come from the same query
+    account = (shipment.get("Consignee__r") or {}) if shipment.get("Consignee__c") else {}
+    items = get_child_records(sf, shipment, "Container_Items__r")
+    deposits = get_child_records(sf, shipment, "Receipt_Reconciliation__r")
+    refunds = get_child_records(sf, shipment, "Cases__r")
 
     # Build debug data for response
     debug_data = {
-        "shipment": {k: v for k, v in shipment.items() if k != "attributes"},
+        "shipment": {
+            k: v for k, v in shipment.items()
+            if k not in ("attributes", "Consignee__r", "Container_Items__r", "Receipt_Reconciliation__r", "Cases__r")
+        },
         "account": {k: v for k, v in account.items() if k != "attributes"} if account else {},
         "container_items": [
             {k: v for k, v in item.items() if k != "attributes"}
@@ -808,7 +1096,7 @@ def generate_invoice(shipment_id: str):
         "template_used": template_path,
     }
 
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb["Invoice"] if "Invoice" in wb.sheetnames else wb.active
 
     # Format Port of Origin in uppercase
@@ -833,28 +1121,16 @@ def generate_invoice(shipment_id: str):
         "{{Shipment__c.Departure_Date_ETD__c}}": shipment.get("Departure_Date_ETD__c") or "",
         "{{Shipment__c.Arrival_Schedule_ETA__c}}": shipment.get("Arrival_Schedule_ETA__c") or "",
         "{{Shipment__c.Remark_number_on_documents__c}}": shipment.get("Remark_number_on_documents__c") or "",
-        "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}": shipment.get("Subtotal_USD__c") or 0,
+        "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}": shipment.get("Subtotal_USD__c"),
         "{{Shipment__c.Fumigation__c}}": shipment.get("Fumigation__c") or "",
-        "{{Shipment__c.Total_Price_USD__c\\# #,##0.##}}": shipment.get("Total_Price_USD__c") or 0,
+        "{{Shipment__c.Total_Price_USD__c\\# #,##0.##}}": shipment.get("Total_Price_USD__c"),
         "{{Shipment__c.In_words__c}}": shipment.get("In_words__c") or "",
 
         # 🔹 NEW: discount placeholders used by invoice_template_w_discount.xlsx
         "{{Shipment__c.Discount_Percentage__c}}": shipment.get("Discount_Percentage__c") or "",
-        "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c") or 0,
+        "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c"),
     }
 
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                for placeholder, value in replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-
-    # Clean "None"
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and "None" in cell.value:
-                cell.value = cell.value.replace("None", "")
-
     # 💡 FIXED: correct parameter order for checkboxes + uppercase
     freight_checkbox_text = format_picklist_checkboxes(
         freight_options, shipment.get("Freight__c"), uppercase=True
@@ -865,50 +1141,79 @@ def generate_invoice(shipment_id: str):
     terms_of_payment_checkbox_text = format_picklist_checkboxes(
         terms_of_payment_options, shipment.get("Terms_of_Payment__c"), uppercase=True
     )
+    checkbox_placeholders = {
+        "{{Shipment__c.Freight__c}}": freight_checkbox_text,
+        "{{Shipment__c.Terms_of_Sales__c}}": terms_of_sales_checkbox_text,
+        "{{Shipment__c.Terms_of_Payment__c}}": terms_of_payment_checkbox_text,
+    }
+
+    # Subtotal/total/discount cells get the number itself plus a number format
+    numeric_placeholders = split_number_format_placeholders(replacements)
+
+    # One pass over the sheet: placeholders, checkboxes and table marker
+    # (missing values become "", never "None")
+    substitutions = {
+        placeholder: "" if value is None else str(value)
+        for placeholder, value in replacements.items()
+    }
+    substitutions.update(checkbox_placeholders)
+    fill_placeholders = compile_placeholder_pattern(substitutions)
+
+    # Checkbox cells keep their horizontal/vertical alignment and only gain wrap_text;
+    # build each wrapped Alignment once and share it between cells
+    wrap_alignments = {}
 
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Shipment__c.Freight__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Freight__c}}", freight_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Sales__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Sales__c}}", terms_of_sales_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Payment__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Payment__c}}", terms_of_payment_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-
-    # --- ContainerItems table expansion ---
     table_start_row = None
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column):
+    for row in ws.iter_rows():
         for cell in row:
-            if isinstance(cell.value, str) and "{{TableStart:ContainerItems}}" in cell.value:
+            value = cell.value
+            if not isinstance(value, str):
+                continue
+            if table_start_row is None and "{{TableStart:ContainerItems}}" in value:
                 table_start_row = cell.row
-                break
-        if table_start_row:
-            break
+            numeric = numeric_placeholders.get(value.strip())
+            if numeric is not None:
+                number, number_format = numeric
+                cell.value = number
+                if cell.number_format == "General":
+                    cell.number_format = number_format
+                continue
+            new_value = fill_placeholders(value)
+            if new_value != value:
+                cell.value = new_value
+            if any(placeholder in value for placeholder in checkbox_placeholders):
+                alignment_id = cell._style.alignmentId
+                wrapped = wrap_alignments.get(alignment_id)
+                if wrapped is None:
+                    wrapped = wrap_alignments[alignment_id] = cell.alignment.copy(wrap_text=True)
+                cell.alignment = wrapped
 
     if not table_start_row:
         raise ValueError("No ContainerItems table start marker found in template")
 
     expand_invoice_items_table(ws, table_start_row, len(items) if items else 1)
 
-    for idx, item in enumerate(items):
-        row_idx = table_start_row + idx
-        container_r = item.get("Container__r") or {}
-        line_item_no = item.get("Line_item_no_for_print__c") or str(idx + 1)
-        ws.cell(row_idx, 1).value = line_item_no
-        ws.cell(row_idx, 2).value = item.get("Product_Description__c")
-        ws.cell(row_idx, 3).value = item.get("Length__c")
-        ws.cell(row_idx, 4).value = item.get("Width__c")
-        ws.cell(row_idx, 5).value = item.get("Height__c")
-        ws.cell(row_idx, 6).value = item.get("Quantity_For_print__c")
-        ws.cell(row_idx, 7).value = item.get("Unit_for_print__c")
-        ws.cell(row_idx, 8).value = container_r.get("STT_Cont__c") or container_r.get("Name")
-        ws.cell(row_idx, 9).value = f"{item.get('Sales_Price_USD__c') or ''} {item.get('Charge_Unit__c') or ''}".strip()
-        ws.cell(row_idx, 10).value = item.get("Total_Price_USD__c")
-        ws.cell(row_idx, 11).value = item.get("Order_No__c")
+    item_rows = ws.iter_rows(min_row=table_start_row, max_row=table_start_row + len(items) - 1, max_col=11)
+    item_fields = itemgetter(
+        "Line_item_no_for_print__c", "Product_Description__c", "Length__c", "Width__c", "Height__c",
+        "Quantity_For_print__c", "Unit_for_print__c", "Sales_Price_USD__c", "Charge_Unit__c",
+        "Total_Price_USD__c", "Order_No__c", "Container__r",
+    )
+    for idx, (fields, row_cells) in enumerate(zip(map(item_fields, items), item_rows)):
+        (line_item_no, desc, length, width, height, qty, unit,
+         sales_price, charge_unit, total_price, order_no, container_r) = fields
+        container_r = container_r or {}
+        row_cells[0].value = line_item_no or str(idx + 1)
+        row_cells[1].value = desc
+        row_cells[2].value = length
+        row_cells[3].value = width
+        row_cells[4].value = height
+        row_cells[5].value = qty
+        row_cells[6].value = unit
+        row_cells[7].value = container_r.get("STT_Cont__c") or container_r.get("Name")
+        row_cells[8].value = f"{sales_price or ''} {charge_unit or ''}".strip()
+        row_cells[9].value = total_price
+        row_cells[10].value = order_no
 
     # --- Deposits / refunds / surcharge sections (back to working behaviour) ---
     deposit_text_cell = None
@@ -991,32 +1296,20 @@ def generate_invoice(shipment_id: str):
 
 
     # Save file
-    now = datetime.datetime.now()
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
     file_name = f"Invoice_{shipment.get('Invoice_Packing_list_no__c', shipment['Name'])}_{timestamp}.xlsx"
 
     # Use appropriate output directory based on environment
     output_dir = get_output_directory()
     file_path = output_dir / file_name
 
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
 
     # Upload to Salesforce as ContentVersion
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-
-    content_version = sf.ContentVersion.create(
-        {
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": shipment_id,
-        }
-    )
+    content_version = upload_content_version(sf, file_name, data, shipment_id)
 
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"],
         "freight_options_used": freight_options,
@@ -1027,16 +1320,69 @@ def generate_invoice(shipment_id: str):
         "debug_data": debug_data,
     }
 
-@app.get("/generate-combined-export/{shipment_id}")
-def generate_combined_export(shipment_id: str):
+@app.get("/generate_invoice/{shipment_id}")
+async def generate_invoice(shipment_id: str):
+    """Generate invoice for a shipment (Salesforce + openpyxl work runs in a worker thread)"""
+    return await asyncio.to_thread(run_with_salesforce_session, generate_invoice_file, shipment_id)
+
+# Plain getter for Cell.value (MergedCell has a class-level _value of None), so the
+# fill passes below call a function instead of resolving the property per cell
+_CELL_VALUE = Cell.value.fget
+
+def move_worksheet(ws, target_wb, title):
     """
-    Generate combined packing list and invoice in one Excel file with two sheets.
-    First sheet: "Packing List"
-    Second sheet: "Invoice"
+    Move a filled worksheet into another workbook without copying its cells.
     
-    Parameters:
-    - shipment_id: Salesforce Shipment ID
+    Styles live in per-workbook tables, so each distinct style of the sheet is
+    registered once in the target workbook and the style ids of its cells and
+    row/column dimensions are remapped; the Cell objects themselves are reused.
     """
+    source_wb = ws.parent
+    target_names = target_wb._named_styles.names
+    remapped = {}
+    
+    for obj in chain(ws._cells.values(), ws.row_dimensions.values(), ws.column_dimensions.values()):
+        if not obj.has_style:
+            continue
+        style = obj._style
+        key = tuple(style)
+        new_style = remapped.get(key)
+        if new_style is None:
+            new_style = style_copy(style)
+            new_style.fontId = target_wb._fonts.add(source_wb._fonts[style.fontId])
+            new_style.fillId = target_wb._fills.add(source_wb._fills[style.fillId])
+            new_style.borderId = target_wb._borders.add(source_wb._borders[style.borderId])
+            new_style.protectionId = target_wb._protections.add(source_wb._protections[style.protectionId])
+            new_style.alignmentId = target_wb._alignments.add(source_wb._alignments[style.alignmentId])
+            if style.numFmtId >= BUILTIN_FORMATS_MAX_SIZE:
+                number_format = source_wb._number_formats[style.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+                new_style.numFmtId = target_wb._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+            style_name = source_wb._named_styles[style.xfId].name
+            new_style.xfId = target_names.index(style_name) if style_name in target_names else 0
+            remapped[key] = new_style
+        # Shared, not copied: nothing restyles the moved cells afterwards
+        obj._style = new_style
+    
+    ws._parent = target_wb
+    target_wb._sheets.append(ws)
+    ws.title = title
+    # The sheet was the active tab of its own workbook; left selected, Excel would
+    # open the target with both sheets grouped
+    ws.sheet_view.tabSelected = None
+    return ws
+
+# Invoice section cells of the combined export, by the marker text they contain
+INVOICE_SECTION_MARKERS = {
+    "{{TableStart:InvoiceDeposit}}": "deposit_text",
+    "Reconciled_Amount__c": "deposit_amount",
+    "{{TableStart:Shipment__c.r.Cases__r}}": "refund",
+    "{{TableStart:Surcharges}}": "surcharge_text",
+    "Surcharge_amount_USD__c": "surcharge_amount",
+}
+INVOICE_SECTION_MARKER_RE = re.compile("|".join(map(re.escape, INVOICE_SECTION_MARKERS)))
+
+def generate_combined_export_file(shipment_id: str):
+    validate_sf_id(shipment_id)
     sf = get_salesforce_connection()
     
     # Templates
@@ -1051,13 +1397,10 @@ def generate_combined_export(shipment_id: str):
             detail=f"Packing list template not found at: {packing_list_template_path}"
         )
     
-    # Get picklist values dynamically
-    freight_options = get_picklist_values(sf, 'Shipment__c', 'Freight__c')
-    terms_of_sales_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Sales__c')
-    terms_of_payment_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Payment__c')
-    
-    # Query shipment data (combining fields from both packing list and invoice)
-    shipment_query = f"""
+    # Query shipment data (combining fields from both packing list and invoice);
+    # consignee, bookings, container items, deposits and refunds come back in the
+    # same round trip as relationship fields / subqueries
+    shipment_query = """
     SELECT Name, Consignee__c, Invoice_Packing_list_no__c, Issued_date__c,
            Port_of_Origin__c, Final_Destination__c, Stockyard__c,
            Ocean_Vessel__c, B_L_No__c, Freight__c,
@@ -1066,11 +1409,43 @@ def generate_combined_export(shipment_id: str):
            Terms_of_Sales__c, Terms_of_Payment__c,
            Subtotal_USD__c, Fumigation__c, In_words__c,
            Total_Price_USD__c, Surcharge_amount_USD__c,
-           Discount_Percentage__c, Discount_Amount__c
+           Discount_Percentage__c, Discount_Amount__c,
+           Consignee__r.Name, Consignee__r.BillingStreet, Consignee__r.BillingCity,
+           Consignee__r.BillingPostalCode, Consignee__r.BillingCountry,
+           Consignee__r.Phone, Consignee__r.Fax__c, Consignee__r.VAT__c,
+           (SELECT Cont_Quantity__c
+            FROM Bookings__r),
+           (SELECT Line_item_no_for_print__c, Product_Description__c,
+                   Length__c, Width__c, Height__c,
+                   Quantity_For_print__c, Unit_for_print__c,
+                   Crates__c, Packing__c, Order_No__c,
+                   Sales_Price_USD__c, Charge_Unit__c, Total_Price_USD__c,
+                   Container__r.Name, Container__r.Container_Weight_Regulation__c,
+                   Container__r.STT_Cont__c
+            FROM Container_Items__r
+            ORDER BY Line_item_no_for_print__c),
+           (SELECT Contract_PI__r.Name, Reconciled_Amount__c
+            FROM Receipt_Reconciliation__r),
+           (SELECT Reason, Refund_Amount__c
+            FROM Cases__r)
     FROM Shipment__c
-    WHERE Id = '{shipment_id}'
+    WHERE Id = {shipment_id}
     """
-    shipment_result = sf.query(shipment_query)
+    
+    # Picklist metadata (describe) and the shipment query are independent
+    # round trips, so run them side by side
+    def fetch_picklists():
+        return [
+            get_picklist_values(sf, 'Shipment__c', field_name)
+            for field_name in ('Freight__c', 'Terms_of_Sales__c', 'Terms_of_Payment__c')
+        ]
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        picklists_future = executor.submit(fetch_picklists)
+        shipment_future = executor.submit(sf.query, format_soql(shipment_query, shipment_id=shipment_id))
+        shipment_result = shipment_future.result()
+        freight_options, terms_of_sales_options, terms_of_payment_options = picklists_future.result()
+    
     if not shipment_result["records"]:
         raise HTTPException(status_code=404, detail=f"No Shipment found with ID: {shipment_id}")
     shipment = shipment_result["records"][0]
@@ -1084,63 +1459,22 @@ def generate_combined_export(shipment_id: str):
     )
     invoice_template_path = discount_invoice_template_path if discount_exists else base_invoice_template_path
     
-    # Query account/consignee data
-    if shipment.get("Consignee__c"):
-        account_query = f"""
-        SELECT Name, BillingStreet, BillingCity, BillingPostalCode, BillingCountry,
-               Phone, Fax__c, VAT__c
-        FROM Account
-        WHERE Id = '{shipment['Consignee__c']}'
-        """
-        account_result = sf.query(account_query)
-        account = account_result["records"][0] if account_result["records"] else {}
-    else:
-        account = {}
+    # Account/consignee data
+    account = (shipment.get("Consignee__r") or {}) if shipment.get("Consignee__c") else {}
     
-    # Query bookings (for packing list)
-    bookings_query = f"""
-    SELECT Id, Cont_Quantity__c
-    FROM Booking__c
-    WHERE Shipment__c = '{shipment_id}'
-    """
-    bookings_result = sf.query_all(bookings_query)
-    bookings = bookings_result['records']
+    # Bookings (for packing list)
+    bookings = get_child_records(sf, shipment, "Bookings__r")
     total_containers_from_bookings = sum(booking.get('Cont_Quantity__c') or 0 for booking in bookings)
     
-    # Query container items (both packing list and invoice use this)
-    items_query = f"""
-    SELECT Line_item_no_for_print__c, Product_Description__c,
-           Length__c, Width__c, Height__c,
-           Quantity_For_print__c, Unit_for_print__c,
-           Crates__c, Packing__c, Order_No__c,
-           Sales_Price_USD__c, Charge_Unit__c, Total_Price_USD__c,
-           Container__r.Name, Container__r.Container_Weight_Regulation__c,
-           Container__r.STT_Cont__c
-    FROM Container_Item__c
-    WHERE Shipment__c = '{shipment_id}'
-    ORDER BY Line_item_no_for_print__c
-    """
-    items_result = sf.query_all(items_query)
-    items = items_result["records"]
-    
-    # Query deposits (for invoice)
-    deposit_query = f"""
-    SELECT Contract_PI__r.Name, Reconciled_Amount__c
-    FROM Receipt_Reconciliation__c
-    WHERE Invoice__c = '{shipment_id}'
-    """
-    deposits = sf.query_all(deposit_query)["records"]
+    # Container items (both packing list and invoice use this)
+    items = get_child_records(sf, shipment, "Container_Items__r")
     
-    # Query refunds (for invoice)
-    refunds_query = f"""
-    SELECT Reason, Refund_Amount__c
-    FROM Case
-    WHERE Refund_in_Shipment__c = '{shipment_id}'
-    """
-    refunds = sf.query_all(refunds_query)["records"]
+    # Deposits and refunds (for invoice)
+    deposits = get_child_records(sf, shipment, "Receipt_Reconciliation__r")
+    refunds = get_child_records(sf, shipment, "Cases__r")
     
     # ===== GENERATE PACKING LIST SHEET =====
-    wb_packing = openpyxl.load_workbook(packing_list_template_path)
+    wb_packing = load_template_workbook(packing_list_template_path)
     ws_packing = wb_packing['PackingList']
     
     # Packing list replacements
@@ -1167,80 +1501,82 @@ def generate_combined_export(shipment_id: str):
         '{{Shipment__c.Terms_of_Payment__c}}': shipment.get('Terms_of_Payment__c') or '',
     }
     
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                for placeholder, value in packing_replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-                if '{{TableStart:Shipment__c.r.Bookings__r}}' in cell.value:
-                    cell.value = str(total_containers_from_bookings)
-    
-    # Remove "None" values
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str) and 'None' in cell.value:
-                cell.value = cell.value.replace('None', '')
-    
-    # Handle freight checkboxes for packing list
-    freight_value = (shipment.get('Freight__c') or '').strip()
-    freight_upper = freight_value.upper()
-    checked_box = '☑'
-    unchecked_box = '☐'
-    
-    lines = []
-    for opt in freight_options:
-        mark = checked_box if opt.upper() == freight_upper else unchecked_box
-        lines.append(f"{mark} {opt}")
-    checkbox_text = "\n".join(lines)
+    # Freight checkboxes for packing list
+    checkbox_text = format_picklist_checkboxes(freight_options, shipment.get('Freight__c'))
     
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-                cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
-                if cell.alignment:
-                    new_alignment = style_copy(cell.alignment)
-                else:
-                    from openpyxl.styles import Alignment
-                    new_alignment = Alignment()
-                new_alignment.wrap_text = True
-                cell.alignment = new_alignment
+    # Bookings total replaces its marker cell, found once per template version
+    bookings_coord = template_marker_coord(
+        packing_list_template_path, ws_packing.title, '{{TableStart:Shipment__c.r.Bookings__r}}'
+    )
+    if bookings_coord:
+        ws_packing.cell(*bookings_coord).value = str(total_containers_from_bookings)
     
-    # Find table start row for packing list
+    # One pass over the sheet: placeholders, "None" cleanup, freight checkboxes
+    fill_packing = compile_placeholder_pattern(
+        {placeholder: str(value) for placeholder, value in packing_replacements.items()}
+    )
+    wrap_alignments = {}
+    # Sheet bounds are read once; every ws.max_row / ws.max_column access rescans the cells
+    packing_max_row = ws_packing.max_row
+    packing_max_col = ws_packing.max_column
     table_start_row = None
-    for row in ws_packing.iter_rows(min_row=1, max_row=ws_packing.max_row, min_col=1, max_col=13):
+    for row in ws_packing.iter_rows(max_row=packing_max_row, max_col=packing_max_col):
         for cell in row:
-            if cell.value and '{{TableStart:ContainerItems}}' in str(cell.value):
+            # data_type is a plain slot; only text cells ('s') can hold placeholders
+            if cell.data_type != 's':
+                continue
+            value = _CELL_VALUE(cell)
+            if not value:
+                continue
+            if table_start_row is None and '{{TableStart:ContainerItems}}' in value:
                 table_start_row = cell.row
-                break
-        if table_start_row:
-            break
+            new_value = fill_packing(value)
+            new_value = new_value.replace('None', '')
+            if '{{Shipment__c.Freight__c}}' in new_value:
+                new_value = new_value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
+                alignment_id = cell._style.alignmentId
+                wrapped = wrap_alignments.get(alignment_id)
+                if wrapped is None:
+                    wrapped = wrap_alignments[alignment_id] = cell.alignment.copy(wrap_text=True)
+                cell.alignment = wrapped
+            if new_value != value:
+                cell.value = new_value
     
     if not table_start_row:
         raise ValueError("No table start marker found in packing list template")
     
     # Expand table for packing list
-    expand_items_table(ws_packing, table_start_row, len(items) if items else 1)
-    
-    # Fill in item data for packing list
-    for idx, item in enumerate(items):
-        row = table_start_row + idx
-        container_r = item.get('Container__r', {})
-        line_item_no = item.get('Line_item_no_for_print__c') or str(idx + 1)
-        ws_packing.cell(row, 1).value = line_item_no
-        ws_packing.cell(row, 2).value = item.get('Product_Description__c')
-        ws_packing.cell(row, 3).value = item.get('Length__c')
-        ws_packing.cell(row, 4).value = item.get('Width__c')
-        ws_packing.cell(row, 5).value = item.get('Height__c')
-        ws_packing.cell(row, 6).value = item.get('Quantity_For_print__c') or ''
-        ws_packing.cell(row, 7).value = item.get('Unit_for_print__c') or ''
-        ws_packing.cell(row, 8).value = item.get('Crates__c')
-        ws_packing.cell(row, 9).value = f"{item.get('Packing__c') or ''} pcs/crate"
-        ws_packing.cell(row, 10).value = container_r.get('Container_Weight_Regulation__c')
-        ws_packing.cell(row, 11).value = container_r.get('Name')
-        ws_packing.cell(row, 13).value = item.get('Order_No__c')
+    expand_items_table(
+        ws_packing, table_start_row, len(items) if items else 1,
+        max_row=packing_max_row, max_col=packing_max_col,
+    )
+    
+    # Fill in item data for packing list, one row tuple per item
+    packing_rows = ws_packing.iter_rows(
+        min_row=table_start_row, max_row=table_start_row + len(items) - 1, max_col=13
+    )
+    packing_fields = itemgetter(
+        'Line_item_no_for_print__c', 'Product_Description__c', 'Length__c', 'Width__c', 'Height__c',
+        'Quantity_For_print__c', 'Unit_for_print__c', 'Crates__c', 'Packing__c', 'Order_No__c', 'Container__r'
+    )
+    for idx, (fields, row_cells) in enumerate(zip(map(packing_fields, items), packing_rows)):
+        line_item_no, desc, length, width, height, qty, unit, crates, packing, order_no, container_r = fields
+        container_r = container_r or {}
+        row_cells[0].value = line_item_no or str(idx + 1)
+        row_cells[1].value = desc
+        row_cells[2].value = length
+        row_cells[3].value = width
+        row_cells[4].value = height
+        row_cells[5].value = qty or ''
+        row_cells[6].value = unit or ''
+        row_cells[7].value = crates
+        row_cells[8].value = f"{packing or ''} pcs/crate"
+        row_cells[9].value = container_r.get('Container_Weight_Regulation__c')
+        row_cells[10].value = container_r.get('Name')
+        row_cells[12].value = order_no
     
     # ===== GENERATE INVOICE SHEET =====
-    wb_invoice = openpyxl.load_workbook(invoice_template_path)
+    wb_invoice = load_template_workbook(invoice_template_path)
     ws_invoice = wb_invoice["Invoice"] if "Invoice" in wb_invoice.sheetnames else wb_invoice.active
     
     # Format Port of Origin in uppercase
@@ -1274,18 +1610,6 @@ def generate_combined_export(shipment_id: str):
         "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c") or 0,
     }
     
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                for placeholder, value in invoice_replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-    
-    # Clean "None"
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and "None" in cell.value:
-                cell.value = cell.value.replace("None", "")
-    
     # Format picklist fields with checkboxes (uppercase)
     freight_checkbox_text = format_picklist_checkboxes(
         freight_options, shipment.get("Freight__c"), uppercase=True
@@ -1296,74 +1620,90 @@ def generate_combined_export(shipment_id: str):
     terms_of_payment_checkbox_text = format_picklist_checkboxes(
         terms_of_payment_options, shipment.get("Terms_of_Payment__c"), uppercase=True
     )
+    invoice_checkboxes = {
+        "{{Shipment__c.Freight__c}}": freight_checkbox_text,
+        "{{Shipment__c.Terms_of_Sales__c}}": terms_of_sales_checkbox_text,
+        "{{Shipment__c.Terms_of_Payment__c}}": terms_of_payment_checkbox_text,
+    }
     
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Shipment__c.Freight__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Freight__c}}", freight_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Sales__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Sales__c}}", terms_of_sales_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Payment__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Payment__c}}", terms_of_payment_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-    
-    # Find ContainerItems table for invoice
+    # Everything substituted in the invoice goes through one compiled pattern: values
+    # are stringified (and stripped of "None") once, checkbox text is inserted as-is,
+    # and without refunds the refund amount / TableEnd tokens are blanked
+    invoice_substitutions = {
+        placeholder: str(value).replace("None", "")
+        for placeholder, value in invoice_replacements.items()
+    }
+    invoice_substitutions.update(invoice_checkboxes)
+    if not refunds:
+        invoice_substitutions["{{Refund_Amount__c\\# #,##0.##}}"] = ""
+        invoice_substitutions["{{TableEnd:Shipment__c.r.Cases__r}}"] = ""
+    fill_invoice = compile_placeholder_pattern(invoice_substitutions)
+    
+    # One pass over the sheet: substitutions, checkbox wrapping, the items table
+    # start and the deposit/refund/surcharge cells (Cell objects follow their rows
+    # when the items table is expanded below)
+    invoice_max_row = ws_invoice.max_row
+    invoice_max_col = ws_invoice.max_column
     invoice_table_start_row = None
-    for row in ws_invoice.iter_rows(min_row=1, max_row=ws_invoice.max_row, min_col=1, max_col=ws_invoice.max_column):
+    marker_cells = {}
+    wrap_alignments = {}
+    for row in ws_invoice.iter_rows(max_row=invoice_max_row, max_col=invoice_max_col):
         for cell in row:
-            if isinstance(cell.value, str) and "{{TableStart:ContainerItems}}" in cell.value:
+            if cell.data_type != "s":
+                continue
+            value = _CELL_VALUE(cell)
+            if invoice_table_start_row is None and "{{TableStart:ContainerItems}}" in value:
                 invoice_table_start_row = cell.row
-                break
-        if invoice_table_start_row:
-            break
+            new_value = fill_invoice(value)
+            if new_value != value:
+                # Cells left with only whitespace after the substitution become empty
+                cell.value = None if new_value and not new_value.strip() else new_value
+            if any(placeholder in value for placeholder in invoice_checkboxes):
+                alignment_id = cell._style.alignmentId
+                wrapped = wrap_alignments.get(alignment_id)
+                if wrapped is None:
+                    wrapped = wrap_alignments[alignment_id] = cell.alignment.copy(wrap_text=True)
+                cell.alignment = wrapped
+            for match in INVOICE_SECTION_MARKER_RE.finditer(new_value):
+                marker_cells[INVOICE_SECTION_MARKERS[match.group(0)]] = cell
     
     if not invoice_table_start_row:
         raise ValueError("No ContainerItems table start marker found in invoice template")
     
-    expand_invoice_items_table(ws_invoice, invoice_table_start_row, len(items) if items else 1)
-    
-    for idx, item in enumerate(items):
-        row_idx = invoice_table_start_row + idx
-        container_r = item.get("Container__r") or {}
-        line_item_no = item.get("Line_item_no_for_print__c") or str(idx + 1)
-        ws_invoice.cell(row_idx, 1).value = line_item_no
-        ws_invoice.cell(row_idx, 2).value = item.get("Product_Description__c")
-        ws_invoice.cell(row_idx, 3).value = item.get("Length__c")
-        ws_invoice.cell(row_idx, 4).value = item.get("Width__c")
-        ws_invoice.cell(row_idx, 5).value = item.get("Height__c")
-        ws_invoice.cell(row_idx, 6).value = item.get("Quantity_For_print__c")
-        ws_invoice.cell(row_idx, 7).value = item.get("Unit_for_print__c")
-        ws_invoice.cell(row_idx, 8).value = container_r.get("STT_Cont__c") or container_r.get("Name")
-        ws_invoice.cell(row_idx, 9).value = f"{item.get('Sales_Price_USD__c') or ''} {item.get('Charge_Unit__c') or ''}".strip()
-        ws_invoice.cell(row_idx, 10).value = item.get("Total_Price_USD__c")
-        ws_invoice.cell(row_idx, 11).value = item.get("Order_No__c")
-    
-    # Handle deposits / refunds / surcharge sections
-    deposit_text_cell = None
-    deposit_amount_cell = None
-    refund_cell = None
-    surcharge_text_cell = None
-    surcharge_amount_cell = None
+    expand_invoice_items_table(
+        ws_invoice, invoice_table_start_row, len(items) if items else 1, max_col=invoice_max_col
+    )
     
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if not isinstance(cell.value, str):
-                continue
-            val = cell.value
-            if "{{TableStart:InvoiceDeposit}}" in val:
-                deposit_text_cell = cell
-            if "Reconciled_Amount__c" in val:
-                deposit_amount_cell = cell
-            if "{{TableStart:Shipment__c.r.Cases__r}}" in val:
-                refund_cell = cell
-            if "{{TableStart:Surcharges}}" in val:
-                surcharge_text_cell = cell
-            if "Surcharge_amount_USD__c" in val:
-                surcharge_amount_cell = cell
+    invoice_rows = ws_invoice.iter_rows(
+        min_row=invoice_table_start_row, max_row=invoice_table_start_row + len(items) - 1, max_col=11
+    )
+    invoice_fields = itemgetter(
+        "Line_item_no_for_print__c", "Product_Description__c", "Length__c", "Width__c", "Height__c",
+        "Quantity_For_print__c", "Unit_for_print__c", "Sales_Price_USD__c", "Charge_Unit__c",
+        "Total_Price_USD__c", "Order_No__c", "Container__r",
+    )
+    for idx, (fields, row_cells) in enumerate(zip(map(invoice_fields, items), invoice_rows)):
+        (line_item_no, desc, length, width, height, qty, unit,
+         sales_price, charge_unit, total_price, order_no, container_r) = fields
+        container_r = container_r or {}
+        row_cells[0].value = line_item_no or str(idx + 1)
+        row_cells[1].value = desc
+        row_cells[2].value = length
+        row_cells[3].value = width
+        row_cells[4].value = height
+        row_cells[5].value = qty
+        row_cells[6].value = unit
+        row_cells[7].value = container_r.get("STT_Cont__c") or container_r.get("Name")
+        row_cells[8].value = f"{sales_price or ''} {charge_unit or ''}".strip()
+        row_cells[9].value = total_price
+        row_cells[10].value = order_no
     
+    # Handle deposits / refunds / surcharge sections
+    deposit_text_cell = marker_cells.get("deposit_text")
+    deposit_amount_cell = marker_cells.get("deposit_amount")
+    refund_cell = marker_cells.get("refund")
+    surcharge_text_cell = marker_cells.get("surcharge_text")
+    surcharge_amount_cell = marker_cells.get("surcharge_amount")
     if deposit_text_cell and deposit_amount_cell:
         if deposits:
             labels = []
@@ -1393,16 +1733,6 @@ def generate_combined_export(shipment_id: str):
         else:
             refund_cell.value = None
     
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Refund_Amount__c" in cell.value or "{{TableEnd:Shipment__c.r.Cases__r}}" in cell.value:
-                    if not refunds:
-                        cell.value = cell.value.replace("{{Refund_Amount__c\\# #,##0.##}}", "")
-                        cell.value = cell.value.replace("{{TableEnd:Shipment__c.r.Cases__r}}", "")
-                        if cell.value and not cell.value.strip():
-                            cell.value = None
-    
     surcharge_amount = shipment.get("Surcharge_amount_USD__c")
     if surcharge_text_cell or surcharge_amount_cell:
         if surcharge_amount:
@@ -1417,92 +1747,28 @@ def generate_combined_export(shipment_id: str):
                 surcharge_amount_cell.value = None
     
     # ===== COMBINE INTO ONE WORKBOOK =====
-    # Create a new workbook and copy sheets
-    combined_wb = openpyxl.Workbook()
-    combined_wb.remove(combined_wb.active)  # Remove default sheet
-    
-    # Copy packing list sheet
-    ws_packing_copy = combined_wb.create_sheet("Packing List")
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            new_cell = ws_packing_copy.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
-                new_cell.font = style_copy(cell.font)
-                new_cell.border = style_copy(cell.border)
-                new_cell.fill = style_copy(cell.fill)
-                new_cell.number_format = style_copy(cell.number_format)
-                new_cell.protection = style_copy(cell.protection)
-                new_cell.alignment = style_copy(cell.alignment)
-    
-    # Copy column dimensions
-    for col in ws_packing.column_dimensions:
-        if col in ws_packing.column_dimensions:
-            combined_wb["Packing List"].column_dimensions[col].width = ws_packing.column_dimensions[col].width
-    
-    # Copy row dimensions
-    for row in ws_packing.row_dimensions:
-        if row in ws_packing.row_dimensions:
-            combined_wb["Packing List"].row_dimensions[row].height = ws_packing.row_dimensions[row].height
-    
-    # Copy merged cells
-    for merged_cell in ws_packing.merged_cells.ranges:
-        combined_wb["Packing List"].merge_cells(str(merged_cell))
-    
-    # Copy invoice sheet
-    ws_invoice_copy = combined_wb.create_sheet("Invoice")
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            new_cell = ws_invoice_copy.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
-                new_cell.font = style_copy(cell.font)
-                new_cell.border = style_copy(cell.border)
-                new_cell.fill = style_copy(cell.fill)
-                new_cell.number_format = style_copy(cell.number_format)
-                new_cell.protection = style_copy(cell.protection)
-                new_cell.alignment = style_copy(cell.alignment)
-    
-    # Copy column dimensions
-    for col in ws_invoice.column_dimensions:
-        if col in ws_invoice.column_dimensions:
-            combined_wb["Invoice"].column_dimensions[col].width = ws_invoice.column_dimensions[col].width
-    
-    # Copy row dimensions
-    for row in ws_invoice.row_dimensions:
-        if row in ws_invoice.row_dimensions:
-            combined_wb["Invoice"].row_dimensions[row].height = ws_invoice.row_dimensions[row].height
-    
-    # Copy merged cells
-    for merged_cell in ws_invoice.merged_cells.ranges:
-        combined_wb["Invoice"].merge_cells(str(merged_cell))
-    
+    # The packing list workbook becomes the combined file and the invoice sheet is
+    # moved into it, so neither sheet is copied cell by cell
+    combined_wb = wb_packing
+    ws_packing.title = "Packing List"
+    move_worksheet(ws_invoice, combined_wb, "Invoice")
+    combined_wb.active = ws_packing
     
     # Save combined file
-    now = datetime.datetime.now()
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
     file_name = f"Combined_Export_{shipment.get('Invoice_Packing_list_no__c', shipment['Name'])}_{timestamp}.xlsx"
     
     # Use appropriate output directory based on environment
     output_dir = get_output_directory()
     file_path = output_dir / file_name
     
-    combined_wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(combined_wb, file_path)
     
-    # Upload to Salesforce as ContentVersion
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create(
-        {
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": shipment_id,
-        }
-    )
+    # Upload to Salesforce as ContentVersion (raw bytes, no base64 copy)
+    content_version = upload_content_version(sf, file_name, data, shipment_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"],
         "sheets": ["Packing List", "Invoice"],
@@ -1516,6 +1782,20 @@ def generate_combined_export(shipment_id: str):
         }
     }
 
+@app.get("/generate-combined-export/{shipment_id}")
+async def generate_combined_export(shipment_id: str):
+    """
+    Generate combined packing list and invoice in one Excel file with two sheets.
+    First sheet: "Packing List"
+    Second sheet: "Invoice"
+    
+    Parameters:
+    - shipment_id: Salesforce Shipment ID
+    """
+    if not SF_ID_RE.match(shipment_id):
+        raise HTTPException(status_code=400, detail=f"Invalid Salesforce ID: {shipment_id}")
+    return await asyncio.to_thread(run_with_salesforce_session, generate_combined_export_file, shipment_id)
+
 @app.get("/download/{file_name}")
 async def download_file(file_name: str):
     """
@@ -1551,6 +1831,17 @@ async def download_file(file_name: str):
 
 # --- New Helper Functions for PI, PO, Quote ---
 
+# Shared cell styles of the PI/PO/Quote tables. openpyxl stores a style by value
+# (cell.alignment = ... only records its index in the workbook), so one instance
+# can be assigned to any number of cells
+THIN_SIDE = Side(style='thin')
+THIN_BORDER = Border(left=THIN_SIDE, right=THIN_SIDE, top=THIN_SIDE, bottom=THIN_SIDE)
+ALIGN_CENTER = Alignment(horizontal='center', vertical='center', wrap_text=True)
+ALIGN_LEFT = Alignment(horizontal='left', vertical='center', wrap_text=True)
+ALIGN_TOP_LEFT = Alignment(horizontal='left', vertical='top', wrap_text=True)
+BOLD_TNR_FONT = Font(bold=True, name='Times New Roman', size=11)
+BOLD_UNDERLINE_TNR_FONT = Font(bold=True, underline='single', name='Times New Roman', size=11)
+
 def sanitize_filename(name):
     """
     Sanitize filename by removing or replacing invalid characters.
@@ -1560,6 +1851,40 @@ def sanitize_filename(name):
     # Replace invalid characters with underscore
     return re.sub(r'[<>:"/\\|?*]', '_', str(name))
 
+# "{{Key}}" or "{{Key\\# format}}" field placeholder of the PI/Quote templates
+FIELD_PLACEHOLDER_RE = re.compile(r"\{\{([\w.]+)(?:\\#(.*?))?\}\}")
+
+# Text float() reads as a plain decimal number, once thousands separators are removed
+NUMERIC_TEXT_RE = re.compile(r"\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*")
+
+# {{#if Key '==' 'value'}}then{{else}}otherwise{{/if}} block of the PI/Quote templates
+IF_BLOCK_RE = re.compile(r"\{\{#if\s+([\w\.]+)\s+'=='\s+'([^']+)'\}\}(.*?)\{\{else\}\}(.*?)\{\{/if\}\}", re.DOTALL)
+
+def resolve_if_blocks(text, data):
+    """Replace every {{#if}} block of text by its branch; the comparison ignores case"""
+    def choose_branch(match):
+        key, target_val, true_text, false_text = match.groups()
+        return true_text if str(data.get(key, "")).lower() == target_val.lower() else false_text
+    return IF_BLOCK_RE.sub(choose_branch, text)
+
+@lru_cache(maxsize=256)
+def split_table_template(text):
+    """
+    Split a table cell template into its literal segments and (key, fmt) placeholders.
+    
+    literals has one more entry than placeholders; fmt is None for plain "{{Key}}".
+    """
+    parts = FIELD_PLACEHOLDER_RE.split(text)
+    return tuple(parts[0::3]), tuple(zip(parts[1::3], parts[2::3]))
+
+def format_field_value(value, fmt):
+    """Render one placeholder value the way the PI/Quote templates expect"""
+    if value is None:
+        return ""
+    if fmt and "#,##0.##" in fmt and isinstance(value, (int, float)):
+        return f"{value:,.2f}"
+    return str(value)
+
 def expand_table_by_tag(ws, start_tag, end_tag, data):
     """
     Expand a single row table based on start and end tags.
@@ -1580,13 +1905,16 @@ def expand_table_by_tag(ws, start_tag, end_tag, data):
         print(f"Warning: Table tags {start_tag} not found.")
         return None
 
+    # Both tags go in one substitution pass
+    tags_re = re.compile(f"{re.escape(start_tag)}|{re.escape(end_tag)}")
+
     if not data:
         # Clear tags and placeholders, keep static text
         for col in range(1, ws.max_column + 1):
             cell = ws.cell(row=table_row_idx, column=col)
             if cell.value and isinstance(cell.value, str):
                 # Remove tags
-                val = cell.value.replace(start_tag, "").replace(end_tag, "")
+                val = tags_re.sub("", cell.value)
                 # Remove any remaining placeholders {{...}}
                 val = re.sub(r"\{\{.*?\}\}", "", val)
                 cell.value = val
@@ -1597,98 +1925,64 @@ def expand_table_by_tag(ws, start_tag, end_tag, data):
     
     # Capture styles from the template row
     max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=table_row_idx, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
+    template_cells = next(ws.iter_rows(min_row=table_row_idx, max_row=table_row_idx, max_col=max_col))
+    row_style = [cell._style if cell.has_style else None for cell in template_cells]
     
     row_height = ws.row_dimensions[table_row_idx].height
 
-    # Handle merged cells (shift them down)
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
     # Insert rows if needed
     if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
+        insert_rows_keeping_merges(ws, table_row_idx + 1, add_rows)
         
-        for offset in range(1, add_rows + 1):
-            r = table_row_idx + offset
+        for row_cells in ws.iter_rows(min_row=table_row_idx + 1, max_row=table_row_idx + add_rows, max_col=max_col):
             # Copy row height
             if row_height is not None:
-                ws.row_dimensions[r].height = row_height
+                ws.row_dimensions[row_cells[0].row].height = row_height
                 
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
+            for dst, src, st in zip(row_cells, template_cells, row_style):
                 # Copy value from template row (to preserve placeholders)
-                src_val = ws.cell(row=table_row_idx, column=col).value
-                dst.value = src_val
+                dst.value = src.value
                 
-                # Copy style
-                st = row_style[col - 1]
+                # Copy style. Each cell needs its own StyleArray: openpyxl's
+                # font/border/number_format setters write into it in place
                 if st is not None:
                     dst._style = style_copy(st)
                     
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
-    # Fill data
-    for i, record in enumerate(data):
-        current_row_idx = table_row_idx + i
-        for col in range(1, ws.max_column + 1):
-            cell = ws.cell(row=current_row_idx, column=col)
-            if cell.value and isinstance(cell.value, str):
-                cell_val = cell.value.replace(start_tag, "").replace(end_tag, "")
-                
-                for key, value in record.items():
-                    placeholder = f"{{{{{key}}}}}"
-                    if placeholder in cell_val:
-                        cell_val = cell_val.replace(placeholder, str(value) if value is not None else "")
-                        
-                    pattern = f"\\{{{{{key}\\\\#(.*?)\\}}}}"
-                    matches = re.findall(pattern, cell_val)
-                    for fmt in matches:
-                        try:
-                            if value is not None:
-                                if isinstance(value, (int, float)):
-                                    if "#,##0.##" in fmt:
-                                         formatted_val = "{:,.2f}".format(value)
-                                    else:
-                                         formatted_val = str(value)
-                                    cell_val = cell_val.replace(f"{{{{{key}\\#{fmt}}}}}", formatted_val)
-                                else:
-                                    cell_val = cell_val.replace(f"{{{{{key}\\#{fmt}}}}}", str(value))
-                            else:
-                                cell_val = cell_val.replace(f"{{{{{key}\\#{fmt}}}}}", "")
-                        except:
-                             cell_val = cell_val.replace(f"{{{{{key}\\#{fmt}}}}}", str(value))
+    # Parse every template cell once: all inserted rows carry the same template
+    cell_templates = []
+    for col_idx, cell in enumerate(template_cells):
+        val = cell.value
+        if val and isinstance(val, str):
+            cell_templates.append((col_idx, split_table_template(tags_re.sub("", val))))
 
-                cell.value = cell_val
+    # Fill data
+    data_rows = ws.iter_rows(min_row=table_row_idx, max_row=table_row_idx + num_rows - 1, max_col=max_col)
+    for record, row_cells in zip(data, data_rows):
+        for col_idx, (literals, placeholders) in cell_templates:
+            cell = row_cells[col_idx]
+            pieces = [literals[0]]
+            for (key, fmt), literal in zip(placeholders, literals[1:]):
+                if key in record:
+                    pieces.append(format_field_value(record[key], fmt))
+                elif fmt is None:
+                    pieces.append(f"{{{{{key}}}}}")
+                else:
+                    pieces.append(f"{{{{{key}\\#{fmt}}}}}")
+                pieces.append(literal)
+            cell_val = "".join(pieces)
+            cell.value = cell_val
+            
+            # Attempt to convert to number if it looks like one
+            clean_val = cell_val.replace(',', '')
+            if NUMERIC_TEXT_RE.fullmatch(clean_val):
+                f_val = float(clean_val)
+                is_leading_zero = (len(clean_val) > 1 and clean_val.startswith('0') and not clean_val.startswith('0.'))
                 
-                # Attempt to convert to number if it looks like one
-                if isinstance(cell.value, str):
-                    try:
-                        clean_val = cell.value.replace(',', '')
-                        f_val = float(clean_val)
-                        is_leading_zero = (len(clean_val) > 1 and clean_val.startswith('0') and not clean_val.startswith('0.'))
-                        
-                        if not is_leading_zero:
-                            if f_val.is_integer():
-                                cell.value = int(f_val)
-                            else:
-                                cell.value = f_val
-                    except ValueError:
-                        pass
+                if not is_leading_zero:
+                    if f_val.is_integer():
+                        cell.value = int(f_val)
+                    else:
+                        cell.value = f_val
     
     return table_row_idx
 
@@ -1742,7 +2036,7 @@ def merge_identical_cells(ws, start_row, count, col_idx):
         if cell_val != current_val:
             if row_idx - 1 > start_merge_row:
                 ws.merge_cells(start_row=start_merge_row, start_column=col_idx, end_row=row_idx-1, end_column=col_idx)
-                ws.cell(row=start_merge_row, column=col_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                ws.cell(row=start_merge_row, column=col_idx).alignment = ALIGN_LEFT
                 adjust_row_height_for_merged_cell(ws, start_merge_row, row_idx-1, col_idx, current_val)
             start_merge_row = row_idx
             current_val = cell_val
@@ -1751,7 +2045,7 @@ def merge_identical_cells(ws, start_row, count, col_idx):
     last_row = start_row + count - 1
     if last_row > start_merge_row:
         ws.merge_cells(start_row=start_merge_row, start_column=col_idx, end_row=last_row, end_column=col_idx)
-        ws.cell(row=start_merge_row, column=col_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+        ws.cell(row=start_merge_row, column=col_idx).alignment = ALIGN_LEFT
         adjust_row_height_for_merged_cell(ws, start_merge_row, last_row, col_idx, current_val)
 
 def adjust_row_height_for_merged_cell(ws, start_row, end_row, col_idx, text, line_height_base=25):
@@ -1841,21 +2135,42 @@ def amount_to_words_usd(amount):
 
 # --- PI No Discount Generation ---
 
+# PI queries, bound with format_soql(..., contract_id=...)
+PI_CONTRACT_PRODUCTS_SOQL = """
+    SELECT Id, IsDeleted, Name, CreatedDate, LastModifiedDate, SystemModstamp, LastActivityDate, LastViewedDate, LastReferencedDate, Cont__c, Container_Weight_Regulations__c, Crates__c, Height__c, Length__c, Line_Number__c, Packing__c, Sales_Price__c, Tons__c, Width__c, List_Price__c, Discount__c, Charge_Unit__c, Quantity__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_PI__c, W_PI__c, H_PI__c, PCS_PI__c, Crates_PI__c, Created_Date__c, Packing_PI__c, Product_Discription__c, Charge_Unit_PI__c, Actual_Cont__c, Pending_Cont__c, Clear__c, Actual_Crates__c, Actual_m2__c, Actual_m3__c, Actual_ml__c, Actual_Quantity__c, Actual_Tons__c, Actual_Total_Price_USD__c, Pending_Crates__c, Pending_m2__c, Pending_m3__c, Pending_ml__c, Pending_Quantity__c, Pending_Tons__c, Pending_Amount_USD__c, Delivery_Date__c, Delivery_Quantity__c, Is_Delivery_Quantity_Valid__c, Delivery_Quantity_number__c, Unscheduled_Quantity__c, Line_number_For_print__c, Product__r.Id, Product__r.Name, Product__r.ProductCode, Product__r.Description, Product__r.QuantityScheduleType, Product__r.QuantityInstallmentPeriod, Product__r.NumberOfQuantityInstallments, Product__r.RevenueScheduleType, Product__r.RevenueInstallmentPeriod, Product__r.NumberOfRevenueInstallments, Product__r.IsActive, Product__r.CreatedDate, Product__r.CreatedById, Product__r.LastModifiedDate, Product__r.LastModifiedById, Product__r.SystemModstamp, Product__r.Family, Product__r.ExternalDataSourceId, Product__r.ExternalId, Product__r.DisplayUrl, Product__r.QuantityUnitOfMeasure, Product__r.IsDeleted, Product__r.IsArchived, Product__r.LastViewedDate, Product__r.LastReferencedDate, Product__r.StockKeepingUnit, Product__r.Product_description_in_Vietnamese__c, Product__r.specific_gravity__c, Product__r.Bottom_cladding_coefficient__c, Product__r.STONE_Color_Type__c, Product__r.Packing__c, Product__r.Long__c, Product__r.High__c, Product__r.Width__c, Product__r.Long_special__c, Product__r.High_special__c, Product__r.Image__c, Product__r.Charge_Unit__c, Product__r.Width_special__c, Product__r.STONE_Class__c, Product__r.Description__c, Product__r.List_Price__c, Product__r.Weight_per_unit__c, Product__r.Edge_Finish__c, Product__r.Suppliers__c, Product__r.m_per_unit__c, Product__r.Application__c, Product__r.Surface_Finish__c, Product__r.m3_per_unit__c, Product__r.Pricing_Method__c, Contract__r.Id, Contract__r.OwnerId, Contract__r.IsDeleted, Contract__r.Name, Contract__r.CreatedDate, Contract__r.CreatedById, Contract__r.LastModifiedDate, Contract__r.LastModifiedById, Contract__r.SystemModstamp, Contract__r.LastActivityDate, Contract__r.LastViewedDate, Contract__r.LastReferencedDate, Contract__r.Account__c, Contract__r.Quote__c, Contract__r.Bill_To__c, Contract__r.Bill_To_Name__c, Contract__r.Contact_Name__c, Contract__r.Expiration_Date__c, Contract__r.Export_Route_Carrier__c, Contract__r.Fax__c, Contract__r.Phone__c, Contract__r.Fumigation__c, Contract__r.Incoterms__c, Contract__r.In_words__c, Contract__r.Packing__c, Contract__r.Port_of_Discharge__c, Contract__r.REMARK_NUMBER_ON_DOCUMENTS__c, Contract__r.Shipping_Schedule__c, Contract__r.Total_Conts__c, Contract__r.Total_Crates__c, Contract__r.Total_m3__c, Contract__r.Sub_Total_USD__c, Contract__r.Total_Tons__c, Contract__r.Deposit_Percentage__c, Contract__r.Discount__c, Contract__r.Total_Price_USD__c, Contract__r.Deposit__c, Contract__r.Stage__c, Contract__r.Total_Payment_Received__c, Contract__r.Expected_ETD__c, Contract__r.Port_of_Origin__c, Contract__r.Price_Book__c, Contract__r.Stockyard__c, Contract__r.Created_Date__c, Contract__r.Total_Contract_Product__c, Contract__r.Pending_Products__c, Contract__r.Total_Payment_Received_USD__c, Contract__r.Production_Order_Number__c, Contract__r.Total_m2__c, Contract__r.Total_Pcs__c, Contract__r.Total_Pcs_PO__c, Contract__r.Planned_Shipments__c, Contract__r.Is_approved__c, Contract__r.Deposited_amount_USD__c, Contract__r.Design_confirmed__c, Contract__r.Contract_type__c, Contract__r.Fully_deposited__c, Contract__r.Discount_Amount__c, Contract__r.Terms_of_Payment__c,    Contract__r.Terms_of_Sale__c, Contract__r.Total_surcharge__c, Contract__r.Customer_PO_number__c FROM Contract_Product__c where Contract__r.Id = {contract_id} ORDER BY Line_Number__c ASC
+"""
+PI_SURCHARGES_SOQL = "SELECT Id, Name, Surcharge_amount_USD__c FROM Expense__c WHERE Contract_PI__r.Id = {contract_id} AND Surcharge_amount_USD__c != 0"
+PI_DEPOSITS_SOQL = "SELECT Id, Name, Reconciled_Amount__c, Contract_PI__r.Name FROM Receipt_Reconciliation__c WHERE Contract_PI__r.Id = {contract_id}"
+PI_DISCOUNTS_SOQL = "SELECT Id, Name, Discount_Amount__c FROM Discount_Item__c WHERE Contract_PI__r.Id = {contract_id}"
+
 def generate_pi_no_discount_file(contract_id: str, template_path: str):
+    validate_sf_id(contract_id)
     sf = get_salesforce_connection()
     
     # Get picklist values for PI
-    incoterms_options = get_picklist_values(sf, 'Contract__c', 'Incoterms__c')
-    terms_of_sale_options = get_picklist_values(sf, 'Contract__c', 'Terms_of_Sale__c')
-    terms_of_payment_options = get_picklist_values(sf, 'Contract__c', 'Terms_of_Payment__c')
+    def fetch_picklists():
+        return [
+            get_picklist_values(sf, 'Contract__c', field_name)
+            for field_name in ('Incoterms__c', 'Terms_of_Sale__c', 'Terms_of_Payment__c')
+        ]
     
     # Query Contract (Full Query from reference script)
-    contract_query = f"""
-    SELECT Id, IsDeleted, Name, CreatedDate, LastModifiedDate, SystemModstamp, LastActivityDate, LastViewedDate, LastReferencedDate, Cont__c, Container_Weight_Regulations__c, Crates__c, Height__c, Length__c, Line_Number__c, Packing__c, Sales_Price__c, Tons__c, Width__c, List_Price__c, Discount__c, Charge_Unit__c, Quantity__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_PI__c, W_PI__c, H_PI__c, PCS_PI__c, Crates_PI__c, Created_Date__c, Packing_PI__c, Product_Discription__c, Charge_Unit_PI__c, Actual_Cont__c, Pending_Cont__c, Clear__c, Actual_Crates__c, Actual_m2__c, Actual_m3__c, Actual_ml__c, Actual_Quantity__c, Actual_Tons__c, Actual_Total_Price_USD__c, Pending_Crates__c, Pending_m2__c, Pending_m3__c, Pending_ml__c, Pending_Quantity__c, Pending_Tons__c, Pending_Amount_USD__c, Delivery_Date__c, Delivery_Quantity__c, Is_Delivery_Quantity_Valid__c, Delivery_Quantity_number__c, Unscheduled_Quantity__c, Line_number_For_print__c, Product__r.Id, Product__r.Name, Product__r.ProductCode, Product__r.Description, Product__r.QuantityScheduleType, Product__r.QuantityInstallmentPeriod, Product__r.NumberOfQuantityInstallments, Product__r.RevenueScheduleType, Product__r.RevenueInstallmentPeriod, Product__r.NumberOfRevenueInstallments, Product__r.IsActive, Product__r.CreatedDate, Product__r.CreatedById, Product__r.LastModifiedDate, Product__r.LastModifiedById, Product__r.SystemModstamp, Product__r.Family, Product__r.ExternalDataSourceId, Product__r.ExternalId, Product__r.DisplayUrl, Product__r.QuantityUnitOfMeasure, Product__r.IsDeleted, Product__r.IsArchived, Product__r.LastViewedDate, Product__r.LastReferencedDate, Product__r.StockKeepingUnit, Product__r.Product_description_in_Vietnamese__c, Product__r.specific_gravity__c, Product__r.Bottom_cladding_coefficient__c, Product__r.STONE_Color_Type__c, Product__r.Packing__c, Product__r.Long__c, Product__r.High__c, Product__r.Width__c, Product__r.Long_special__c, Product__r.High_special__c, Product__r.Image__c, Product__r.Charge_Unit__c, Product__r.Width_special__c, Product__r.STONE_Class__c, Product__r.Description__c, Product__r.List_Price__c, Product__r.Weight_per_unit__c, Product__r.Edge_Finish__c, Product__r.Suppliers__c, Product__r.m_per_unit__c, Product__r.Application__c, Product__r.Surface_Finish__c, Product__r.m3_per_unit__c, Product__r.Pricing_Method__c, Contract__r.Id, Contract__r.OwnerId, Contract__r.IsDeleted, Contract__r.Name, Contract__r.CreatedDate, Contract__r.CreatedById, Contract__r.LastModifiedDate, Contract__r.LastModifiedById, Contract__r.SystemModstamp, Contract__r.LastActivityDate, Contract__r.LastViewedDate, Contract__r.LastReferencedDate, Contract__r.Account__c, Contract__r.Quote__c, Contract__r.Bill_To__c, Contract__r.Bill_To_Name__c, Contract__r.Contact_Name__c, Contract__r.Expiration_Date__c, Contract__r.Export_Route_Carrier__c, Contract__r.Fax__c, Contract__r.Phone__c, Contract__r.Fumigation__c, Contract__r.Incoterms__c, Contract__r.In_words__c, Contract__r.Packing__c, Contract__r.Port_of_Discharge__c, Contract__r.REMARK_NUMBER_ON_DOCUMENTS__c, Contract__r.Shipping_Schedule__c, Contract__r.Total_Conts__c, Contract__r.Total_Crates__c, Contract__r.Total_m3__c, Contract__r.Sub_Total_USD__c, Contract__r.Total_Tons__c, Contract__r.Deposit_Percentage__c, Contract__r.Discount__c, Contract__r.Total_Price_USD__c, Contract__r.Deposit__c, Contract__r.Stage__c, Contract__r.Total_Payment_Received__c, Contract__r.Expected_ETD__c, Contract__r.Port_of_Origin__c, Contract__r.Price_Book__c, Contract__r.Stockyard__c, Contract__r.Created_Date__c, Contract__r.Total_Contract_Product__c, Contract__r.Pending_Products__c, Contract__r.Total_Payment_Received_USD__c, Contract__r.Production_Order_Number__c, Contract__r.Total_m2__c, Contract__r.Total_Pcs__c, Contract__r.Total_Pcs_PO__c, Contract__r.Planned_Shipments__c, Contract__r.Is_approved__c, Contract__r.Deposited_amount_USD__c, Contract__r.Design_confirmed__c, Contract__r.Contract_type__c, Contract__r.Fully_deposited__c, Contract__r.Discount_Amount__c, Contract__r.Terms_of_Payment__c,    Contract__r.Terms_of_Sale__c, Contract__r.Total_surcharge__c, Contract__r.Customer_PO_number__c FROM Contract_Product__c where Contract__r.Id = '{contract_id}' ORDER BY Line_Number__c ASC
-    """
+    contract_query = format_soql(PI_CONTRACT_PRODUCTS_SOQL, contract_id=contract_id)
+    surcharge_query = format_soql(PI_SURCHARGES_SOQL, contract_id=contract_id)
+    deposit_query = format_soql(PI_DEPOSITS_SOQL, contract_id=contract_id)
+    discount_query = format_soql(PI_DISCOUNTS_SOQL, contract_id=contract_id)
+    
+    # None of these depend on each other, so they go out side by side
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        picklists_future = executor.submit(fetch_picklists)
+        contract_future = executor.submit(sf.query_all, contract_query)
+        surcharge_future = executor.submit(sf.query_all, surcharge_query)
+        deposit_future = executor.submit(sf.query_all, deposit_query)
+        discount_future = executor.submit(sf.query_all, discount_query)
+    incoterms_options, terms_of_sale_options, terms_of_payment_options = picklists_future.result()
     
     try:
-        result = sf.query_all(contract_query)
+        result = contract_future.result()
     except Exception as e:
         print(f"Error querying contract: {e}")
         raise ValueError(f"Error querying contract: {e}")
@@ -1890,9 +2205,8 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
         item['Line_number_For_print__c'] = idx + 1
 
     # Query Surcharges
-    surcharge_query = f"SELECT Id, Name, Surcharge_amount_USD__c FROM Expense__c WHERE Contract_PI__r.Id = '{contract_id}' AND Surcharge_amount_USD__c != 0"
     try:
-        sur_result = sf.query_all(surcharge_query)
+        sur_result = surcharge_future.result()
         surcharge_records = sur_result['records']
     except Exception as e:
         surcharge_records = []
@@ -1905,9 +2219,8 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
         })
 
     # Query Deposits (Receipt_Reconciliation__c)
-    deposit_query = f"SELECT Id, Name, Reconciled_Amount__c, Contract_PI__r.Name FROM Receipt_Reconciliation__c WHERE Contract_PI__r.Id = '{contract_id}'"
     try:
-        dep_result = sf.query_all(deposit_query)
+        dep_result = deposit_future.result()
         deposit_records = dep_result['records']
     except Exception as e:
         deposit_records = []
@@ -1923,8 +2236,7 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
     # Query Discounts (Discount_Item__c - Placeholder)
     discount_items = []
     try:
-        discount_query = f"SELECT Id, Name, Discount_Amount__c FROM Discount_Item__c WHERE Contract_PI__r.Id = '{contract_id}'"
-        disc_result = sf.query_all(discount_query)
+        disc_result = discount_future.result()
         discount_records = disc_result['records']
         for item in discount_records:
             val = item.get('Discount_Amount__c')
@@ -1972,14 +2284,22 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
             print(f"Warning: Template {template_path} not found, falling back to original argument or risking error.")
 
     # Load Template
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
 
+    def replace_field(match):
+        key, fmt = match.groups()
+        if key not in full_data:
+            return match.group(0)
+        return format_field_value(full_data[key], fmt)
+
     # Fill Main Data
     for row in ws.iter_rows():
         for cell in row:
             if cell.value and isinstance(cell.value, str):
                 val = cell.value
+                if "{{" not in val:
+                    continue
 
                 # ===== Handle Incoterms with checkbox formatting =====
                 if "{{Contract__c.Incoterms__c}}" in val:
@@ -2024,16 +2344,7 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                     cell.alignment = new_alignment
                 
                 # Conditional Logic
-                if_pattern = r"\{\{#if\s+([\w\.]+)\s+'=='\s+'([^']+)'\}\}(.*?)\{\{else\}\}(.*?)\{\{/if\}\}"
-                if_matches = re.findall(if_pattern, val)
-                for match in if_matches:
-                    key, target_val, true_text, false_text = match
-                    full_match_str = f"{{{{#if {key} '==' '{target_val}'}}}}{true_text}{{{{else}}}}{false_text}{{{{/if}}}}"
-                    actual_val = str(full_data.get(key, ""))
-                    if actual_val.lower() == target_val.lower():
-                        val = val.replace(full_match_str, true_text)
-                    else:
-                        val = val.replace(full_match_str, false_text)
+                val = resolve_if_blocks(val, full_data)
 
                 # Float Fields
                 float_fields = [
@@ -2092,63 +2403,38 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                     continue
 
                 # General Replacement
-                for key, value in full_data.items():
-                    placeholder = f"{{{{{key}}}}}"
-                    if placeholder in val:
-                        val = val.replace(placeholder, str(value) if value is not None else "")
-                    
-                    pattern = f"\\{{{{{key}\\\\#(.*?)\\}}}}"
-                    matches = re.findall(pattern, val)
-                    for fmt in matches:
-                         if value is not None and isinstance(value, (int, float)):
-                             if "#,##0.##" in fmt:
-                                 formatted_val = "{:,.2f}".format(value)
-                             else:
-                                 formatted_val = str(value)
-                             val = val.replace(f"{{{{{key}\\#{fmt}}}}}", formatted_val)
-                         else:
-                             val = val.replace(f"{{{{{key}\\#{fmt}}}}}", str(value) if value is not None else "")
-                cell.value = val
+                cell.value = FIELD_PLACEHOLDER_RE.sub(replace_field, val)
 
     # Fill Product Table
     table_start_row = expand_table_by_tag(ws, "{{TableStart:ContractProduct2}}", "{{TableEnd:ContractProduct2}}", contract_items)
     
     if table_start_row and contract_items:
-        # Merge duplicate "TÊN HÀNG" (Column B / 2) - MỚI
-        if contract_items:
-            start_row = table_start_row 
-            end_row = table_start_row + len(contract_items) - 1 
-            col_b_idx = 2
+        # One pass over the product rows: merge duplicate "TÊN HÀNG" (Column B / 2)
+        # runs - with K, L, M (11, 12, 13) merged alongside - and format the
+        # Price Columns (L=12, M=13) and Packing (N=14)
+        end_row = table_start_row + len(contract_items) - 1
+
+        def merge_run(first_row, last_row):
+            if last_row > first_row:
+                ws.merge_cells(start_row=first_row, start_column=2, end_row=last_row, end_column=2)
+                ws.cell(row=first_row, column=2).alignment = ALIGN_LEFT
+                for col_idx in [11, 12, 13]:
+                    ws.merge_cells(start_row=first_row, start_column=col_idx, end_row=last_row, end_column=col_idx)
+                    ws.cell(row=first_row, column=col_idx).alignment = ALIGN_CENTER
+
+        merge_start_row = table_start_row
+        current_val = ws.cell(row=table_start_row, column=2).value
+        product_rows = ws.iter_rows(min_row=table_start_row, max_row=end_row, min_col=2, max_col=14)
+        for item, row_cells in zip(contract_items, product_rows):
+            cell_desc = row_cells[0]
+            cell_price, cell_total, cell_packing = row_cells[10:13]
             
-            merge_start_row = start_row
-            current_val = ws.cell(row=start_row, column=col_b_idx).value
-            
-            from openpyxl.styles import Alignment
-            for r in range(start_row + 1, end_row + 2): 
-                val = ws.cell(row=r, column=col_b_idx).value if r <= end_row else "SENTINEL"
-                
-                should_break = (val != current_val)
-                
-                if should_break:
-                    if r - 1 > merge_start_row:
-                        ws.merge_cells(start_row=merge_start_row, start_column=col_b_idx, end_row=r-1, end_column=col_b_idx)
-                        ws.cell(row=merge_start_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                        
-                        # Merge K, L, M (11, 12, 13)
-                        for col_idx in [11, 12, 13]:
-                            ws.merge_cells(start_row=merge_start_row, start_column=col_idx, end_row=r-1, end_column=col_idx)
-                            # Center alignment for merged price/amount cells
-                            ws.cell(row=merge_start_row, column=col_idx).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+            if cell_desc.value != current_val:
+                merge_run(merge_start_row, cell_desc.row - 1)
+                merge_start_row = cell_desc.row
+                current_val = cell_desc.value
 
-                    merge_start_row = r
-                    current_val = val
-
-        # Format Price Columns (L=12, M=13) and Packing (G=7)
-        for i in range(len(contract_items)):
-            row_idx = table_start_row + i
-            
             # Column 14 (Packing): Custom Format "pcs/crates"
-            cell_packing = ws.cell(row=row_idx, column=14)
             if cell_packing.value is not None:
                 try:
                     # Ensure it is a number
@@ -2162,14 +2448,11 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                     pass
 
             # Unit Price
-            cell = ws.cell(row=row_idx, column=12)
-            item = contract_items[i]
-            
             # Use raw numeric value from record to ensure it's a number in Excel
             val_raw = item.get('Sales_Price__c')
             if val_raw is not None:
                 try:
-                    cell.value = float(val_raw)
+                    cell_price.value = float(val_raw)
 
                     # Determine Unit Suffix
                     unit_raw = item.get('Charge_Unit_PI__c')
@@ -2183,19 +2466,20 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                     else:
                         suffix = "USD"
 
-                    cell.number_format = f'#,##0.00 "{suffix}"'
+                    cell_price.number_format = f'#,##0.00 "{suffix}"'
                 except: pass
             
             # Total Price
-            cell = ws.cell(row=row_idx, column=13)
             # Use raw numeric value for total price too
             total_raw = item.get('Total_Price_USD__c')
             if total_raw is not None:
                 try:
-                    cell.value = float(total_raw)
-                    cell.number_format = '#,##0.00'
+                    cell_total.value = float(total_raw)
+                    cell_total.number_format = '#,##0.00'
                 except: pass
 
+        merge_run(merge_start_row, end_row)
+
     # Fill Surcharges
     sur_start = expand_table_by_tag(ws, "{{TableStart:PISurcharge}}", "{{TableEnd:PISurcharge}}", surcharge_items)
     if sur_start and surcharge_items:
@@ -2220,18 +2504,15 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
     # -------------------------------------------------------------------------
     # SỬA ĐỔI: LOGIC MERGE CỘT A-J (1-10) TỰ ĐỘNG THEO SUBTOTAL VÀ TOTAL
     # -------------------------------------------------------------------------
-    from openpyxl.styles import Alignment
-    
     start_merge_row = None
     end_merge_row = None
 
     # Quét qua các dòng để tìm vị trí thực tế của Subtotal và Total
     # Vì các bảng ở trên (Surcharge, Discount...) có thể giãn ra, số dòng sẽ thay đổi.
-    for r in range(1, ws.max_row + 1):
+    for r, row_values in enumerate(ws.iter_rows(max_col=14, values_only=True), start=1):
         # Lấy nội dung text của cả dòng để kiểm tra từ khóa
         row_text_u = ""
-        for c in range(1, 15): # Quét 15 cột đầu
-            val = ws.cell(row=r, column=c).value
+        for val in row_values: # Quét 15 cột đầu
             if val:
                 row_text_u += str(val).upper()
         
@@ -2279,10 +2560,10 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
             
             # Bước 3: Căn chỉnh lại text (Căn trái, lên trên)
             cell = ws.cell(row=start_merge_row, column=1)
-            cell.alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+            cell.alignment = ALIGN_TOP_LEFT
             
             cell_total = ws.cell(row=end_merge_row, column=1)
-            cell_total.alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+            cell_total.alignment = ALIGN_TOP_LEFT
             
             print(f"Merged A-J from row {start_merge_row} (Subtotal) to {end_merge_row-1} (Total-1) and row {end_merge_row} (Total)")
         except Exception as e:
@@ -2299,28 +2580,21 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
     prefix = "PI_Discount_" if has_discount else "PI_NoDiscount_"
     file_name = f"{prefix}{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = upload_content_version(sf, file_name, data, contract_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"]
     }
 
 @app.get("/generate-pi-no-discount/{contract_id}")
 async def generate_pi_no_discount_endpoint(contract_id: str):
+    if not SF_ID_RE.match(contract_id):
+        raise HTTPException(status_code=400, detail=f"Invalid Salesforce ID: {contract_id}")
     try:
         template_path = os.getenv('PI_NO_DISCOUNT_TEMPLATE_PATH', 'templates/proforma_invoice_template_no_discount.xlsx')
         if not os.path.exists(template_path):
@@ -2330,54 +2604,68 @@ async def generate_pi_no_discount_endpoint(contract_id: str):
              else:
                  raise HTTPException(status_code=404, detail=f"Template not found: {template_path}")
         
-        result = generate_pi_no_discount_file(contract_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_pi_no_discount_file, contract_id, template_path)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- Production Order Generation ---
 
+# Production order queries, bound with format_soql(..., contract_id=...)
+PO_CONTRACT_SOQL = """
+    SELECT Id, Production_Order_Number__c, Name, CreatedDate, Port_of_Origin__c, 
+           Port_of_Discharge__c, Stockyard__c, Total_Pcs_PO__c, Total_Crates__c, 
+           Total_m2__c, Total_m3__c, Total_Tons__c, Total_Conts__c, Terms_of_Sale__c
+    FROM Contract__c 
+    WHERE Id = {contract_id}
+"""
+PO_ORDER_PRODUCTS_SOQL = """
+    SELECT Id, IsDeleted, Name, CreatedDate, LastModifiedDate, SystemModstamp, LastActivityDate, LastViewedDate, LastReferencedDate, Charge_Unit__c, Cont__c, Container_Weight_Regulations__c, Crates__c, Height__c, Length__c, List_Price__c, Quantity__c, Width__c, m2__c, m3__c, ml__c, Packing__c, Sales_Price__c, Tons__c, Total_Price_USD__c, Actual_Cont__c, Actual_Crates__c, Actual_Quantity__c, Actual_Tons__c, Actual_m2__c, Actual_m3__c, Actual_ml__c, Product_Description__c, Actual_Total_Price_USD__c, Pending_Cont__c, Pending_Crates__c, Pending_m2__c, Pending_m3__c, Pending_ml__c, Pending_Quantity__c, Pending_Amount_USD__c, Pending_Tons__c, Delivery_Date__c, Planned_Quantity__c, Total_Child_Order_Actual_Quantity__c, Pending_Quantity_for_child_2__c, Delivered_date__c, Line_number__c, Line_item_no_for_print__c, SKU__c, Vietnamese_Description__c, Order__r.Name, Order__r.Delivery_Date__c, Contract_PI__r.Id 
+    FROM Order_Product__c 
+    WHERE Contract_PI__r.Id = {contract_id} 
+    ORDER BY Line_number__c ASC
+"""
+PO_CONTRACT_PRODUCTS_SOQL = """
+    SELECT Id, Name, Quantity__c, Crates__c, m2__c, m3__c, Tons__c, Cont__c, 
+           Length__c, Width__c, Height__c, Packing__c, Delivery_Date__c,
+           Product__r.Name, Product__r.ProductCode, Product__r.Product_description_in_Vietnamese__c,
+           Contract__r.Name
+    FROM Contract_Product__c 
+    WHERE Contract__r.Id = {contract_id}
+    ORDER BY Line_Number__c ASC
+"""
+
+# Description runs of the production order: bold product name, regular details
+PO_DESC_BOLD_FONT = InlineFont(b=True, rFont='Times New Roman', sz=11)
+PO_DESC_REGULAR_FONT = InlineFont(b=False, rFont='Times New Roman', sz=11)
+
 def generate_production_order_file(contract_id: str, template_path: str):
+    validate_sf_id(contract_id)
     sf = get_salesforce_connection()
     
     # Query Contract
-    contract_query = f"""
-        SELECT Id, Production_Order_Number__c, Name, CreatedDate, Port_of_Origin__c, 
-               Port_of_Discharge__c, Stockyard__c, Total_Pcs_PO__c, Total_Crates__c, 
-               Total_m2__c, Total_m3__c, Total_Tons__c, Total_Conts__c, Terms_of_Sale__c
-        FROM Contract__c 
-        WHERE Id = '{contract_id}'
-    """
+    contract_query = format_soql(PO_CONTRACT_SOQL, contract_id=contract_id)
+    # Query Order Products
+    products_query = format_soql(PO_ORDER_PRODUCTS_SOQL, contract_id=contract_id)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        contract_future = executor.submit(sf.query, contract_query)
+        products_future = executor.submit(sf.query, products_query)
+
     try:
-        contract_res = sf.query(contract_query)
+        contract_res = contract_future.result()
         contract_data = contract_res['records'][0] if contract_res['totalSize'] > 0 else {}
     except Exception as e:
         print(f"Error querying Contract: {e}")
         raise ValueError(f"Error querying Contract: {e}")
 
-    # Query Order Products
-    products_query = f"""
-        SELECT Id, IsDeleted, Name, CreatedDate, LastModifiedDate, SystemModstamp, LastActivityDate, LastViewedDate, LastReferencedDate, Charge_Unit__c, Cont__c, Container_Weight_Regulations__c, Crates__c, Height__c, Length__c, List_Price__c, Quantity__c, Width__c, m2__c, m3__c, ml__c, Packing__c, Sales_Price__c, Tons__c, Total_Price_USD__c, Actual_Cont__c, Actual_Crates__c, Actual_Quantity__c, Actual_Tons__c, Actual_m2__c, Actual_m3__c, Actual_ml__c, Product_Description__c, Actual_Total_Price_USD__c, Pending_Cont__c, Pending_Crates__c, Pending_m2__c, Pending_m3__c, Pending_ml__c, Pending_Quantity__c, Pending_Amount_USD__c, Pending_Tons__c, Delivery_Date__c, Planned_Quantity__c, Total_Child_Order_Actual_Quantity__c, Pending_Quantity_for_child_2__c, Delivered_date__c, Line_number__c, Line_item_no_for_print__c, SKU__c, Vietnamese_Description__c, Order__r.Name, Order__r.Delivery_Date__c, Contract_PI__r.Id 
-        FROM Order_Product__c 
-        WHERE Contract_PI__r.Id = '{contract_id}' 
-        ORDER BY Line_number__c ASC
-    """
     try:
-        products_res = sf.query(products_query)
+        products_res = products_future.result()
         products_data = products_res['records']
         
         # FALLBACK: If no Order Products found, query Contract Product items instead
         if not products_data:
             print(f"No Order Products found for {contract_id}, falling back to Contract Products...")
-            cp_query = f"""
-                SELECT Id, Name, Quantity__c, Crates__c, m2__c, m3__c, Tons__c, Cont__c, 
-                       Length__c, Width__c, Height__c, Packing__c, Delivery_Date__c,
-                       Product__r.Name, Product__r.ProductCode, Product__r.Product_description_in_Vietnamese__c,
-                       Contract__r.Name
-                FROM Contract_Product__c 
-                WHERE Contract__r.Id = '{contract_id}'
-                ORDER BY Line_Number__c ASC
-            """
+            cp_query = format_soql(PO_CONTRACT_PRODUCTS_SOQL, contract_id=contract_id)
             cp_res = sf.query(cp_query)
             if cp_res['records']:
                 for item in cp_res['records']:
@@ -2404,7 +2692,7 @@ def generate_production_order_file(contract_id: str, template_path: str):
         print(f"Error querying items: {e}")
         products_data = []
 
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
 
     # Flatten data
@@ -2428,10 +2716,17 @@ def generate_production_order_file(contract_id: str, template_path: str):
         "Contract__c.Total_Conts__c"
     ]
 
+    # The product table row is recorded during the fill pass, not by a second scan
+    table_start_row = None
+    formatted_dates = {}
     for row in ws.iter_rows():
         for cell in row:
             if cell.value and isinstance(cell.value, str):
                 val = cell.value
+                if "{{" not in val:
+                    continue
+                if table_start_row is None and cell.column == 1 and "{{TableStart:ProPlanProduct}}" in val:
+                    table_start_row = cell.row
                 
                 # Check for smart formatting fields first (exact match of {{Placeholder}})
                 is_numeric_total = False
@@ -2466,28 +2761,27 @@ def generate_production_order_file(contract_id: str, template_path: str):
                         if replace_val is None: replace_val = ""
                         
                         if format_part and replace_val:
-                            try:
-                                 val_str = str(replace_val).split('T')[0]
-                                 if 'T' in str(replace_val):
-                                      dt = datetime.datetime.strptime(str(replace_val).split('+')[0].split('.')[0], "%Y-%m-%dT%H:%M:%S")
-                                 else:
-                                      dt = datetime.datetime.strptime(val_str, "%Y-%m-%d")
-                                 py_format = format_part.replace('dd', '%d').replace('MM', '%m').replace('yyyy', '%Y')
-                                 replace_val = dt.strftime(py_format)
-                            except: pass
+                            # Parse each (field, format) pair once per document
+                            date_key = (key_part, format_part)
+                            if date_key not in formatted_dates:
+                                formatted = replace_val
+                                try:
+                                     val_str = str(replace_val).split('T')[0]
+                                     if 'T' in str(replace_val):
+                                          dt = datetime.datetime.strptime(str(replace_val).split('+')[0].split('.')[0], "%Y-%m-%dT%H:%M:%S")
+                                     else:
+                                          dt = datetime.datetime.strptime(val_str, "%Y-%m-%d")
+                                     py_format = format_part.replace('dd', '%d').replace('MM', '%m').replace('yyyy', '%Y')
+                                     formatted = dt.strftime(py_format)
+                                except: pass
+                                formatted_dates[date_key] = formatted
+                            replace_val = formatted_dates[date_key]
                         
                         val = val.replace(f"{{{{{match}}}}}", str(replace_val))
                         cell.alignment = Alignment(wrap_text=True, vertical='center', horizontal=cell.alignment.horizontal if cell.alignment else 'left')
                 cell.value = val
 
     # Fill Table
-    table_start_row = None
-    for r in range(1, ws.max_row + 1):
-        cell_val = ws.cell(row=r, column=1).value
-        if cell_val and "{{TableStart:ProPlanProduct}}" in str(cell_val):
-            table_start_row = r
-            break
-            
     if table_start_row:
         if products_data:
             num_items = len(products_data)
@@ -2560,16 +2854,12 @@ def generate_production_order_file(contract_id: str, template_path: str):
                                        end_row=new_max_row, end_column=merge_info['max_col'])
                     except: pass
 
-            thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-            align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
             
             # Copy styles
             if num_items > 1:
-                for i in range(1, num_items):
-                    for col in range(1, 16):
-                        source_cell = ws.cell(row=table_start_row, column=col)
-                        target_cell = ws.cell(row=table_start_row + i, column=col)
+                source_cells = next(ws.iter_rows(min_row=table_start_row, max_row=table_start_row, max_col=15))
+                for target_cells in ws.iter_rows(min_row=table_start_row + 1, max_row=table_start_row + num_items - 1, max_col=15):
+                    for source_cell, target_cell in zip(source_cells, target_cells):
                         if source_cell.border: target_cell.border = style_copy(source_cell.border)
                         if source_cell.font: target_cell.font = style_copy(source_cell.font)
                         if source_cell.alignment: target_cell.alignment = style_copy(source_cell.alignment)
@@ -2577,68 +2867,72 @@ def generate_production_order_file(contract_id: str, template_path: str):
 
             ws.cell(row=table_start_row, column=1).value = ""
             
-            for i, item in enumerate(products_data):
-                row_idx = table_start_row + i
-                
-                # Unmerge
-                for col in range(1, 16):
-                    cell = ws.cell(row=row_idx, column=col)
-                    for merged_range in list(ws.merged_cells.ranges):
-                        if cell.coordinate in merged_range:
-                            try: ws.unmerge_cells(str(merged_range))
-                            except: pass
-                    ws.cell(row=row_idx, column=col).border = thin_border
+            # Unmerge everything overlapping the product block (A-O) in one pass
+            table_end_row = table_start_row + num_items - 1
+            to_unmerge = [
+                str(merged_range) for merged_range in ws.merged_cells.ranges
+                if merged_range.min_row <= table_end_row and merged_range.max_row >= table_start_row
+                and merged_range.min_col <= 15
+            ]
+            for rng in to_unmerge:
+                try: ws.unmerge_cells(rng)
+                except: pass
+
+            product_rows = ws.iter_rows(min_row=table_start_row, max_row=table_end_row, max_col=15)
+            for i, (item, row_cells) in enumerate(zip(products_data, product_rows)):
+                for cell in row_cells:
+                    cell.border = THIN_BORDER
 
                 # Map Data
-                ws.cell(row=row_idx, column=1).value = i + 1
-                ws.cell(row=row_idx, column=1).alignment = align_center
-                ws.cell(row=row_idx, column=2).value = item.get("Order__r", {}).get("Name") if item.get("Order__r") else ""
-                ws.cell(row=row_idx, column=2).alignment = align_center
-                ws.cell(row=row_idx, column=3).value = item.get("SKU__c")
-                ws.cell(row=row_idx, column=3).alignment = align_left
+                row_cells[0].value = i + 1
+                row_cells[0].alignment = ALIGN_CENTER
+                row_cells[1].value = item.get("Order__r", {}).get("Name") if item.get("Order__r") else ""
+                row_cells[1].alignment = ALIGN_CENTER
+                row_cells[2].value = item.get("SKU__c")
+                row_cells[2].alignment = ALIGN_LEFT
                 
                 # Rich Text Description
                 desc_val = item.get("Vietnamese_Description__c") or ""
                 if desc_val and '-' in str(desc_val):
                     parts = str(desc_val).split('-', 1)
                     rich_text = CellRichText(
-                        TextBlock(InlineFont(b=True, rFont='Times New Roman', sz=11), parts[0]),
-                        TextBlock(InlineFont(b=False, rFont='Times New Roman', sz=11), '-' + parts[1])
+                        TextBlock(PO_DESC_BOLD_FONT, parts[0]),
+                        TextBlock(PO_DESC_REGULAR_FONT, '-' + parts[1])
                     )
-                    ws.cell(row=row_idx, column=4).value = rich_text
+                    row_cells[3].value = rich_text
                 else:
-                    ws.cell(row=row_idx, column=4).value = desc_val
-                ws.cell(row=row_idx, column=4).alignment = align_left
+                    row_cells[3].value = desc_val
+                row_cells[3].alignment = ALIGN_LEFT
                 
                 # Dimensions & Quantity
-                ws.cell(row=row_idx, column=5).value = item.get("Length__c")
-                ws.cell(row=row_idx, column=6).value = item.get("Width__c")
-                ws.cell(row=row_idx, column=7).value = item.get("Height__c")
-                ws.cell(row=row_idx, column=8).value = item.get("Quantity__c")
-                ws.cell(row=row_idx, column=9).value = item.get("Crates__c")
+                row_cells[4].value = item.get("Length__c")
+                row_cells[5].value = item.get("Width__c")
+                row_cells[6].value = item.get("Height__c")
+                row_cells[7].value = item.get("Quantity__c")
+                row_cells[8].value = item.get("Crates__c")
                 
                 if item.get("m2__c"): 
-                    ws.cell(row=row_idx, column=10).value = float(item.get("m2__c"))
-                    ws.cell(row=row_idx, column=10).number_format = '0.00'
+                    row_cells[9].value = float(item.get("m2__c"))
+                    row_cells[9].number_format = '0.00'
                 if item.get("m3__c"):
-                    ws.cell(row=row_idx, column=11).value = float(item.get("m3__c"))
-                    ws.cell(row=row_idx, column=11).number_format = '0.00'
+                    row_cells[10].value = float(item.get("m3__c"))
+                    row_cells[10].number_format = '0.00'
                     
-                ws.cell(row=row_idx, column=12).value = item.get("Tons__c")
-                ws.cell(row=row_idx, column=13).value = item.get("Cont__c")
+                row_cells[11].value = item.get("Tons__c")
+                row_cells[12].value = item.get("Cont__c")
                 
-                for col in range(5, 14): ws.cell(row=row_idx, column=col).alignment = align_center
+                for cell in row_cells[4:13]: cell.alignment = ALIGN_CENTER
                 
                 # Packing
                 packing_val = item.get("Packing__c")
                 if packing_val:
                     try:
                         # Chuyển sang int
-                        ws.cell(row=row_idx, column=14).value = int(float(packing_val))
-                        ws.cell(row=row_idx, column=14).number_format = '0 "viên/kiện"'
+                        row_cells[13].value = int(float(packing_val))
+                        row_cells[13].number_format = '0 "viên/kiện"'
                     except:
-                        ws.cell(row=row_idx, column=14).value = f"{packing_val}\nviên/kiện"
-                ws.cell(row=row_idx, column=14).alignment = align_center
+                        row_cells[13].value = f"{packing_val}\nviên/kiện"
+                row_cells[13].alignment = ALIGN_CENTER
                 
                 # Delivery Date
                 del_date = item.get("Delivery_Date__c")
@@ -2649,10 +2943,10 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 if del_date:
                     try:
                         dt = datetime.datetime.strptime(del_date[:10], "%Y-%m-%d")
-                        ws.cell(row=row_idx, column=15).value = dt.strftime("%d/%m/%Y")
+                        row_cells[14].value = dt.strftime("%d/%m/%Y")
                     except:
-                        ws.cell(row=row_idx, column=15).value = del_date
-                ws.cell(row=row_idx, column=15).alignment = align_center
+                        row_cells[14].value = del_date
+                row_cells[14].alignment = ALIGN_CENTER
 
             # Merge duplicate "TÊN HÀNG" (Column D / 4) - Sync with Delivery Date Logic
             start_merge_row = table_start_row
@@ -2663,13 +2957,13 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 if val != current_val:
                     if row_idx - 1 > start_merge_row:
                         ws.merge_cells(start_row=start_merge_row, start_column=4, end_row=row_idx-1, end_column=4)
-                        ws.cell(row=start_merge_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                        ws.cell(row=start_merge_row, column=4).alignment = ALIGN_LEFT
                     start_merge_row = row_idx
                     current_val = val
             last_row = table_start_row + len(products_data) - 1
             if last_row > start_merge_row:
                 ws.merge_cells(start_row=start_merge_row, start_column=4, end_row=last_row, end_column=4)
-                ws.cell(row=start_merge_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                ws.cell(row=start_merge_row, column=4).alignment = ALIGN_LEFT
             
             # Merge duplicate "THỜI GIAN GIAO HÀNG" (Column O / 15)
             start_merge_row = table_start_row
@@ -2680,13 +2974,13 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 if val != current_val:
                     if row_idx - 1 > start_merge_row:
                         ws.merge_cells(start_row=start_merge_row, start_column=15, end_row=row_idx-1, end_column=15)
-                        ws.cell(row=start_merge_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                        ws.cell(row=start_merge_row, column=15).alignment = ALIGN_CENTER
                     start_merge_row = row_idx
                     current_val = val
             last_row = table_start_row + len(products_data) - 1
             if last_row > start_merge_row:
                 ws.merge_cells(start_row=start_merge_row, start_column=15, end_row=last_row, end_column=15)
-                ws.cell(row=start_merge_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                ws.cell(row=start_merge_row, column=15).alignment = ALIGN_CENTER
         else:
             # CLEANUP: If no products_data, clear placeholders and tags from the template row
             for col in range(1, 16):
@@ -2705,13 +2999,14 @@ def generate_production_order_file(contract_id: str, template_path: str):
     # ----------------------------------------------------
     # MERGE I, J, K FOR ROWS WITH "Người soạn lệnh" OR "Ngọc Bích"
     # ----------------------------------------------------
+    max_col = ws.max_column
     for r in range(1, ws.max_row + 1):
         found_keyword = False
         row_values_ijk = []
         target_val = None
         
         # Check entire row to find the keyword "Người soạn lệnh" or "Ngọc Bích"
-        for col in range(1, ws.max_column + 1):
+        for col in range(1, max_col + 1):
             cell = ws.cell(row=r, column=col)
             if cell.value and isinstance(cell.value, str):
                 val_upper = str(cell.value).strip().upper()
@@ -2741,12 +3036,12 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 # Apply Styling
                 val_str = str(final_val).upper() if final_val else ""
                 if "NGƯỜI SOẠN LỆNH" in val_str or "NGƯỜI SOAN LỆNH" in val_str:
-                    ws.cell(row=r, column=9).font = Font(bold=True, underline='single', name='Times New Roman', size=11)
+                    ws.cell(row=r, column=9).font = BOLD_UNDERLINE_TNR_FONT
                 elif "NGỌC BÍCH" in val_str:
-                    ws.cell(row=r, column=9).font = Font(bold=True, name='Times New Roman', size=11)
+                    ws.cell(row=r, column=9).font = BOLD_TNR_FONT
                 
                 ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
-                ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                ws.cell(row=r, column=9).alignment = ALIGN_CENTER
             except Exception as e:
                 print(f"Error merging IJK at row {r}: {e}")
 
@@ -2756,22 +3051,13 @@ def generate_production_order_file(contract_id: str, template_path: str):
     file_name = f"Production_Order_{safe_name}_{timestamp}.xlsx"
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = upload_content_version(sf, file_name, data, contract_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"]
     }
@@ -2780,24 +3066,41 @@ def generate_production_order_file(contract_id: str, template_path: str):
 
 # --- Quote No Discount Generation ---
 
+# Quote queries, bound with format_soql(..., quote_id=...)
+QUOTE_LINE_ITEMS_SOQL = """
+    SELECT Id, IsDeleted, LineNumber, CreatedDate, LastModifiedDate, SystemModstamp, LastViewedDate, LastReferencedDate, Quantity, UnitPrice, Discount, HasRevenueSchedule, HasQuantitySchedule, Description, ServiceDate, SortOrder, HasSchedule, ListPrice, Subtotal, TotalPrice, Product_Description__c, Length__c, Width__c, Height__c, Line_Number__c, Packing__c, Total_Price_to_sumup__c, Cont__c, Crates__c, Tons__c, Container_Weight_Regulations__c, Discount__c, Unit_Price__c, L_x_W_x_H__c, ml_x_m2_x_m3__c, Crates_and_Packing__c, Unit_Price_USD__c, ChargeUnit__c, Product_Name__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_Quote__c, W_Quote__c, H_Quote__c, PCS_Quote__c, Crates_Quote__c, Charge_Unit_Quote__c, Packing_Quote__c, Quote_Line_Item_Number_Quote__c, Opportunity_Id__c, Quote_display_name__c, Quote.Id, Quote.OwnerId, Quote.IsDeleted, Quote.Name, Quote.RecordTypeId, Quote.CreatedDate, Quote.CreatedById, Quote.LastModifiedDate, Quote.LastModifiedById, Quote.SystemModstamp, Quote.LastViewedDate, Quote.LastReferencedDate, Quote.OpportunityId, Quote.Pricebook2Id, Quote.ContactId, Quote.QuoteNumber, Quote.IsSyncing, Quote.ShippingHandling, Quote.Tax, Quote.Status, Quote.ExpirationDate, Quote.Description, Quote.Subtotal, Quote.TotalPrice, Quote.LineItemCount, Quote.BillingStreet, Quote.BillingCity, Quote.BillingState, Quote.BillingPostalCode, Quote.BillingCountry, Quote.BillingLatitude, Quote.BillingLongitude, Quote.BillingGeocodeAccuracy, Quote.BillingAddress, Quote.ShippingStreet, Quote.ShippingCity, Quote.ShippingState, Quote.ShippingPostalCode, Quote.ShippingCountry, Quote.ShippingLatitude, Quote.ShippingLongitude, Quote.ShippingGeocodeAccuracy, Quote.ShippingAddress, Quote.QuoteToStreet, Quote.QuoteToCity, Quote.QuoteToState, Quote.QuoteToPostalCode, Quote.QuoteToCountry, Quote.QuoteToLatitude, Quote.QuoteToLongitude, Quote.QuoteToGeocodeAccuracy, Quote.QuoteToAddress, Quote.AdditionalStreet, Quote.AdditionalCity, Quote.AdditionalState, Quote.AdditionalPostalCode, Quote.AdditionalCountry, Quote.AdditionalLatitude, Quote.AdditionalLongitude, Quote.AdditionalGeocodeAccuracy, Quote.AdditionalAddress, Quote.BillingName, Quote.ShippingName, Quote.QuoteToName, Quote.AdditionalName, Quote.Email, Quote.Phone, Quote.Fax, Quote.ContractId, Quote.AccountId, Quote.Discount, Quote.GrandTotal, Quote.CanCreateQuoteLineItems, Quote.Sub_Total_USD__c, Quote.Fumigation__c, Quote.Total_Crates__c, Quote.Total_m3__c, Quote.Total_Tons__c, Quote.Total_Conts__c, Quote.REMARK_NUMBER_ON_DOCUMENTS__c, Quote.Packing__c, Quote.Shipping_Schedule__c, Quote.Port_of_Discharge__c, Quote.Export_Route_Carrier__c, Quote.In_words__c, Quote.Discount__c, Quote.Total_Price_USD__c, Quote.Total_Quote_Line_Items__c, Quote.Port_of_Origin__c, Quote.Stockyard__c, Quote.Created_Date__c, Quote.Discount_Amount__c, Quote.Is_new_quote__c, Quote.First_approved_by__c, Quote.Final_approved_by__c, Quote.Account_approved_pricebook__c, Quote.Is_approved__c, Quote.Terms_of_Sale__c, Quote.Terms_of_Payment__c, Quote.Incoterms__c, 
+           Quote.Account.Name, Quote.Account.BillingStreet, Quote.Account.BillingCity, Quote.Account.BillingPostalCode, Quote.Account.BillingCountry, Quote.Account.Phone, Quote.Account.Fax__c, Quote.Account.VAT__c 
+    FROM QuoteLineItem 
+    WHERE QuoteId = {quote_id} 
+    ORDER BY Quote_Line_Item_Number_Quote__c ASC
+"""
+QUOTE_DISCOUNTS_SOQL = "SELECT Id, Name, Discount_Amount__c FROM Discount_Item__c WHERE Quote__c = {quote_id}"
+# Quote.Account.* fields selected with the line items, flattened into the template data
+QUOTE_ACCOUNT_FIELDS = ("Name", "BillingStreet", "BillingCity", "BillingPostalCode", "BillingCountry", "Phone", "Fax__c", "VAT__c")
+
 def generate_quote_no_discount_file(quote_id: str, template_path: str):
+    validate_sf_id(quote_id)
     sf = get_salesforce_connection()
 
     # Get picklist values for Quote
-    incoterms_options = get_picklist_values(sf, 'Quote', 'Incoterms__c')
-    terms_of_sale_options = get_picklist_values(sf, 'Quote', 'Terms_of_Sale__c')
-    terms_of_payment_options = get_picklist_values(sf, 'Quote', 'Terms_of_Payment__c')
+    def fetch_picklists():
+        return [
+            get_picklist_values(sf, 'Quote', field_name)
+            for field_name in ('Incoterms__c', 'Terms_of_Sale__c', 'Terms_of_Payment__c')
+        ]
     
     # Query Quote Items (Full Query)
-    query = f"""
-    SELECT Id, IsDeleted, LineNumber, CreatedDate, LastModifiedDate, SystemModstamp, LastViewedDate, LastReferencedDate, Quantity, UnitPrice, Discount, HasRevenueSchedule, HasQuantitySchedule, Description, ServiceDate, SortOrder, HasSchedule, ListPrice, Subtotal, TotalPrice, Product_Description__c, Length__c, Width__c, Height__c, Line_Number__c, Packing__c, Total_Price_to_sumup__c, Cont__c, Crates__c, Tons__c, Container_Weight_Regulations__c, Discount__c, Unit_Price__c, L_x_W_x_H__c, ml_x_m2_x_m3__c, Crates_and_Packing__c, Unit_Price_USD__c, ChargeUnit__c, Product_Name__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_Quote__c, W_Quote__c, H_Quote__c, PCS_Quote__c, Crates_Quote__c, Charge_Unit_Quote__c, Packing_Quote__c, Quote_Line_Item_Number_Quote__c, Opportunity_Id__c, Quote_display_name__c, Quote.Id, Quote.OwnerId, Quote.IsDeleted, Quote.Name, Quote.RecordTypeId, Quote.CreatedDate, Quote.CreatedById, Quote.LastModifiedDate, Quote.LastModifiedById, Quote.SystemModstamp, Quote.LastViewedDate, Quote.LastReferencedDate, Quote.OpportunityId, Quote.Pricebook2Id, Quote.ContactId, Quote.QuoteNumber, Quote.IsSyncing, Quote.ShippingHandling, Quote.Tax, Quote.Status, Quote.ExpirationDate, Quote.Description, Quote.Subtotal, Quote.TotalPrice, Quote.LineItemCount, Quote.BillingStreet, Quote.BillingCity, Quote.BillingState, Quote.BillingPostalCode, Quote.BillingCountry, Quote.BillingLatitude, Quote.BillingLongitude, Quote.BillingGeocodeAccuracy, Quote.BillingAddress, Quote.ShippingStreet, Quote.ShippingCity, Quote.ShippingState, Quote.ShippingPostalCode, Quote.ShippingCountry, Quote.ShippingLatitude, Quote.ShippingLongitude, Quote.ShippingGeocodeAccuracy, Quote.ShippingAddress, Quote.QuoteToStreet, Quote.QuoteToCity, Quote.QuoteToState, Quote.QuoteToPostalCode, Quote.QuoteToCountry, Quote.QuoteToLatitude, Quote.QuoteToLongitude, Quote.QuoteToGeocodeAccuracy, Quote.QuoteToAddress, Quote.AdditionalStreet, Quote.AdditionalCity, Quote.AdditionalState, Quote.AdditionalPostalCode, Quote.AdditionalCountry, Quote.AdditionalLatitude, Quote.AdditionalLongitude, Quote.AdditionalGeocodeAccuracy, Quote.AdditionalAddress, Quote.BillingName, Quote.ShippingName, Quote.QuoteToName, Quote.AdditionalName, Quote.Email, Quote.Phone, Quote.Fax, Quote.ContractId, Quote.AccountId, Quote.Discount, Quote.GrandTotal, Quote.CanCreateQuoteLineItems, Quote.Sub_Total_USD__c, Quote.Fumigation__c, Quote.Total_Crates__c, Quote.Total_m3__c, Quote.Total_Tons__c, Quote.Total_Conts__c, Quote.REMARK_NUMBER_ON_DOCUMENTS__c, Quote.Packing__c, Quote.Shipping_Schedule__c, Quote.Port_of_Discharge__c, Quote.Export_Route_Carrier__c, Quote.In_words__c, Quote.Discount__c, Quote.Total_Price_USD__c, Quote.Total_Quote_Line_Items__c, Quote.Port_of_Origin__c, Quote.Stockyard__c, Quote.Created_Date__c, Quote.Discount_Amount__c, Quote.Is_new_quote__c, Quote.First_approved_by__c, Quote.Final_approved_by__c, Quote.Account_approved_pricebook__c, Quote.Is_approved__c, Quote.Terms_of_Sale__c, Quote.Terms_of_Payment__c, Quote.Incoterms__c 
-    FROM QuoteLineItem 
-    WHERE QuoteId = '{quote_id}' 
-    ORDER BY Quote_Line_Item_Number_Quote__c ASC
-    """
+    query = format_soql(QUOTE_LINE_ITEMS_SOQL, quote_id=quote_id)
+    discount_query = format_soql(QUOTE_DISCOUNTS_SOQL, quote_id=quote_id)
+    
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        picklists_future = executor.submit(fetch_picklists)
+        items_future = executor.submit(sf.query_all, query)
+        discount_future = executor.submit(sf.query_all, discount_query)
+    incoterms_options, terms_of_sale_options, terms_of_payment_options = picklists_future.result()
     
     try:
-        result = sf.query_all(query)
+        result = items_future.result()
     except Exception as e:
         print(f"Error querying quote items: {e}")
         raise ValueError(f"Error querying quote items: {e}")
@@ -2805,7 +3108,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
     if not result['records']:
         # Try fetching just the Quote if no items
         try:
-            q_res = sf.query(f"SELECT Id, Name FROM Quote WHERE Id = '{quote_id}'")
+            q_res = sf.query(format_soql("SELECT Id, Name FROM Quote WHERE Id = {quote_id}", quote_id=quote_id))
             if q_res['records']:
                 quote_data = q_res['records'][0]
                 quote_items = []
@@ -2821,20 +3124,14 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
         else:
             raise ValueError("Quote data missing in line items.")
 
-    # Flatten Data
+    # Flatten Data (the Account comes with the line items as Quote.Account.*)
+    account = quote_data.pop('Account', None)
     full_data = {}
     for k, v in quote_data.items():
         full_data[f"Quote.{k}"] = v
-        
-    # Fetch Account
-    account_id = quote_data.get('AccountId')
-    if account_id:
-        acc_fields = ["Name", "BillingStreet", "BillingCity", "BillingPostalCode", "BillingCountry", "Phone", "Fax__c", "VAT__c"]
-        try:
-            acc = sf.Account.get(account_id)
-            for k in acc_fields:
-                full_data[f"Quote.Account.{k}"] = acc.get(k)
-        except: pass
+    if account:
+        for k in QUOTE_ACCOUNT_FIELDS:
+            full_data[f"Quote.Account.{k}"] = account.get(k)
 
     # Inject Sequential Number
     for idx, item in enumerate(quote_items):
@@ -2843,8 +3140,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
     # Query Discounts (Discount_Item__c - Placeholder)
     discount_items = []
     try:
-        discount_query = f"SELECT Id, Name, Discount_Amount__c FROM Discount_Item__c WHERE Quote__c = '{quote_id}'"
-        disc_result = sf.query_all(discount_query)
+        disc_result = discount_future.result()
         discount_records = disc_result['records']
         for item in discount_records:
             val = item.get('Discount_Amount__c')
@@ -2882,7 +3178,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
         else:
              print(f"Warning: Template {template_path} not found, falling back to original argument or risking error.")
 
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
 
     # Fill Main Data
@@ -2934,16 +3230,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
                     cell.alignment = new_alignment
                 
                 # Conditional Logic
-                if_pattern = r"\{\{#if\s+([\w\.]+)\s+'=='\s+'([^']+)'\}\}(.*?)\{\{else\}\}(.*?)\{\{/if\}\}"
-                if_matches = re.findall(if_pattern, val)
-                for match in if_matches:
-                    key, target_val, true_text, false_text = match
-                    full_match_str = f"{{{{#if {key} '==' '{target_val}'}}}}{true_text}{{{{else}}}}{false_text}{{{{/if}}}}"
-                    actual_val = str(full_data.get(key, ""))
-                    if actual_val.lower() == target_val.lower():
-                        val = val.replace(full_match_str, true_text)
-                    else:
-                        val = val.replace(full_match_str, false_text)
+                val = resolve_if_blocks(val, full_data)
 
                 # Float Fields
                 float_fields = [
@@ -3043,7 +3330,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
         try:
              ws.merge_cells(start_row=start_merge_row, start_column=1, end_row=end_merge_row, end_column=10)
              cell = ws.cell(row=start_merge_row, column=1)
-             cell.alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+             cell.alignment = ALIGN_TOP_LEFT
         except Exception as e:
             print(f"Merge error: {e}")
 
@@ -3066,7 +3353,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
                 if should_break:
                     if r - 1 > merge_start_row:
                         ws.merge_cells(start_row=merge_start_row, start_column=col_b_idx, end_row=r-1, end_column=col_b_idx)
-                        ws.cell(row=merge_start_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                        ws.cell(row=merge_start_row, column=col_b_idx).alignment = ALIGN_LEFT
                     
                     merge_start_row = r
                     current_val = val
@@ -3107,22 +3394,13 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
     file_name = f"{prefix}{safe_name}_{timestamp}.xlsx"
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": quote_id
-    })
+    content_version = upload_content_version(sf, file_name, data, quote_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"]
     }
@@ -3173,19 +3451,9 @@ def expand_table_pi(ws, start_tag, end_tag, data):
     
     row_height = ws.row_dimensions[table_row_idx].height
 
-    # Handle merged cells (shift them down)
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
     # Insert rows if needed
     if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
+        insert_rows_keeping_merges(ws, table_row_idx + 1, add_rows)
         
         for offset in range(1, add_rows + 1):
             r = table_row_idx + offset
@@ -3204,13 +3472,6 @@ def expand_table_pi(ws, start_tag, end_tag, data):
                 if st is not None:
                     dst._style = style_copy(st)
                     
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
     # Fill data
     for i, record in enumerate(data):
         current_row_idx = table_row_idx + i
@@ -3265,27 +3526,38 @@ def get_picklist_values(sf, object_name, field_name):
     """
     Fetch picklist values for a given object and field from Salesforce.
     """
-    try:
-        desc = getattr(sf, object_name).describe()
-        for field in desc['fields']:
-            if field['name'] == field_name:
-                return [entry['value'] for entry in field['picklistValues']]
-    except Exception as e:
-        print(f"Error fetching picklist values for {object_name}.{field_name}: {e}")
-    return []
+    def fetch():
+        try:
+            desc = describe_sobject(sf, object_name)
+            for field in desc['fields']:
+                if field['name'] == field_name:
+                    return [entry['value'] for entry in field['picklistValues']]
+        except SalesforceExpiredSession:
+            raise
+        except Exception as e:
+            print(f"Error fetching picklist values for {object_name}.{field_name}: {e}")
+        return []
+
+    return cached_picklist_values(fetch, object_name, field_name)
 
 def format_picklist_checkboxes(options, selected_value, uppercase=False):
     """
     Format picklist options as a checkbox list.
     Mark the selected value with [x], others with [ ].
     """
-    formatted_lines = []
     if selected_value is None:
         selected_value = ""
     
     # Normalize selected value for comparison
     selected_value_norm = str(selected_value).strip().lower()
     
+    # Options come from the picklist cache and rarely change, so the rendered
+    # text is memoized per (options, selection, case)
+    return _render_picklist_checkboxes(tuple(options), selected_value_norm, uppercase)
+
+@lru_cache(maxsize=256)
+def _render_picklist_checkboxes(options, selected_value_norm, uppercase):
+    formatted_lines = []
     for opt in options:
         opt_label = str(opt)
         if uppercase:
@@ -3368,7 +3640,7 @@ def generate_pi_no_discount_logic(contract_id, template_path):
     for idx, item in enumerate(contract_items):
         item['Line_number_For_print__c'] = idx + 1
     
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
     
     for row in ws.iter_rows():
@@ -3533,13 +3805,13 @@ def generate_pi_no_discount_logic(contract_id, template_path):
                 if row_idx - 1 > start_merge_row:
                     ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=row_idx-1, end_column=col_b_idx)
                     cell = ws.cell(row=start_merge_row, column=col_b_idx)
-                    cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                    cell.alignment = ALIGN_LEFT
                 start_merge_row = row_idx
                 current_val = cell_val
         last_row = table_start_row + len(contract_items) - 1
         if last_row > start_merge_row:
              ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=last_row, end_column=col_b_idx)
-             ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+             ws.cell(row=start_merge_row, column=col_b_idx).alignment = ALIGN_LEFT
 
     if table_start_row and contract_items:
         for i in range(len(contract_items)):
@@ -3613,22 +3885,13 @@ def generate_pi_no_discount_logic(contract_id, template_path):
     safe_name = sanitize_filename(contract_data.get('Name'))
     file_name = f"PI_{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
 
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = upload_content_version(sf, file_name, data, contract_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"]
     }
@@ -3637,9 +3900,10 @@ def generate_pi_no_discount_logic(contract_id, template_path):
 async def generate_pi_no_discount_endpoint(contract_id: str):
     try:
         # Check if contract has discount first
-        sf = get_salesforce_connection()
         query = f"SELECT Discount__c, Discount_Amount__c FROM Contract__c WHERE Id = '{contract_id}'"
-        res = sf.query(query)
+        def fetch_discount():
+            return get_salesforce_connection().query(query)
+        res = await asyncio.to_thread(run_with_salesforce_session, fetch_discount)
         has_discount = False
         if res['totalSize'] > 0:
             rec = res['records'][0]
@@ -3668,7 +3932,7 @@ async def generate_pi_no_discount_endpoint(contract_id: str):
                  else:
                      raise HTTPException(status_code=404, detail=f"PI Template not found: {template_path}")
 
-        result = generate_pi_no_discount_logic(contract_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_pi_no_discount_logic, contract_id, template_path)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3710,17 +3974,8 @@ def expand_table_quote(ws, start_tag, end_tag, data):
     
     row_height = ws.row_dimensions[table_row_idx].height
 
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
     if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
+        insert_rows_keeping_merges(ws, table_row_idx + 1, add_rows)
         for offset in range(1, add_rows + 1):
             r = table_row_idx + offset
             if row_height is not None:
@@ -3733,12 +3988,6 @@ def expand_table_quote(ws, start_tag, end_tag, data):
                 if st is not None:
                     dst._style = style_copy(st)
                     
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
     for i, record in enumerate(data):
         current_row_idx = table_row_idx + i
         for col in range(1, ws.max_column + 1):
@@ -3814,7 +4063,8 @@ def generate_quote_no_discount_logic(quote_id, template_path):
     terms_of_payment_options = get_picklist_values(sf, 'Quote', 'Terms_of_Payment__c')
     
     query = f"""
-    SELECT Id, IsDeleted, LineNumber, CreatedDate, LastModifiedDate, SystemModstamp, LastViewedDate, LastReferencedDate, Quantity, UnitPrice, Discount, HasRevenueSchedule, HasQuantitySchedule, Description, ServiceDate, SortOrder, HasSchedule, ListPrice, Subtotal, TotalPrice, Product_Description__c, Length__c, Width__c, Height__c, Line_Number__c, Packing__c, Total_Price_to_sumup__c, Cont__c, Crates__c, Tons__c, Container_Weight_Regulations__c, Discount__c, Unit_Price__c, L_x_W_x_H__c, ml_x_m2_x_m3__c, Crates_and_Packing__c, Unit_Price_USD__c, ChargeUnit__c, Product_Name__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_Quote__c, W_Quote__c, H_Quote__c, PCS_Quote__c, Crates_Quote__c, Charge_Unit_Quote__c, Packing_Quote__c, Quote_Line_Item_Number_Quote__c, Opportunity_Id__c, Quote_display_name__c, Quote.Id, Quote.OwnerId, Quote.IsDeleted, Quote.Name, Quote.RecordTypeId, Quote.CreatedDate, Quote.CreatedById, Quote.LastModifiedDate, Quote.LastModifiedById, Quote.SystemModstamp, Quote.LastViewedDate, Quote.LastReferencedDate, Quote.OpportunityId, Quote.Pricebook2Id, Quote.ContactId, Quote.QuoteNumber, Quote.IsSyncing, Quote.ShippingHandling, Quote.Tax, Quote.Status, Quote.ExpirationDate, Quote.Description, Quote.Subtotal, Quote.TotalPrice, Quote.LineItemCount, Quote.BillingStreet, Quote.BillingCity, Quote.BillingState, Quote.BillingPostalCode, Quote.BillingCountry, Quote.BillingLatitude, Quote.BillingLongitude, Quote.BillingGeocodeAccuracy, Quote.BillingAddress, Quote.ShippingStreet, Quote.ShippingCity, Quote.ShippingState, Quote.ShippingPostalCode, Quote.ShippingCountry, Quote.ShippingLatitude, Quote.ShippingLongitude, Quote.ShippingGeocodeAccuracy, Quote.ShippingAddress, Quote.QuoteToStreet, Quote.QuoteToCity, Quote.QuoteToState, Quote.QuoteToPostalCode, Quote.QuoteToCountry, Quote.QuoteToLatitude, Quote.QuoteToLongitude, Quote.QuoteToGeocodeAccuracy, Quote.QuoteToAddress, Quote.AdditionalStreet, Quote.AdditionalCity, Quote.AdditionalState, Quote.AdditionalPostalCode, Quote.AdditionalCountry, Quote.AdditionalLatitude, Quote.AdditionalLongitude, Quote.AdditionalGeocodeAccuracy, Quote.AdditionalAddress, Quote.BillingName, Quote.ShippingName, Quote.QuoteToName, Quote.AdditionalName, Quote.Email, Quote.Phone, Quote.Fax, Quote.ContractId, Quote.AccountId, Quote.Discount, Quote.GrandTotal, Quote.CanCreateQuoteLineItems, Quote.Sub_Total_USD__c, Quote.Fumigation__c, Quote.Total_Crates__c, Quote.Total_m3__c, Quote.Total_Tons__c, Quote.Total_Conts__c, Quote.REMARK_NUMBER_ON_DOCUMENTS__c, Quote.Packing__c, Quote.Shipping_Schedule__c, Quote.Port_of_Discharge__c, Quote.Export_Route_Carrier__c, Quote.In_words__c, Quote.Discount__c, Quote.Total_Price_USD__c, Quote.Total_Quote_Line_Items__c, Quote.Port_of_Origin__c, Quote.Stockyard__c, Quote.Created_Date__c, Quote.Discount_Amount__c, Quote.Is_new_quote__c, Quote.First_approved_by__c, Quote.Final_approved_by__c, Quote.Account_approved_pricebook__c, Quote.Is_approved__c, Quote.Terms_of_Sale__c, Quote.Terms_of_Payment__c, Quote.Incoterms__c 
+    SELECT Id, IsDeleted, LineNumber, CreatedDate, LastModifiedDate, SystemModstamp, LastViewedDate, LastReferencedDate, Quantity, UnitPrice, Discount, HasRevenueSchedule, HasQuantitySchedule, Description, ServiceDate, SortOrder, HasSchedule, ListPrice, Subtotal, TotalPrice, Product_Description__c, Length__c, Width__c, Height__c, Line_Number__c, Packing__c, Total_Price_to_sumup__c, Cont__c, Crates__c, Tons__c, Container_Weight_Regulations__c, Discount__c, Unit_Price__c, L_x_W_x_H__c, ml_x_m2_x_m3__c, Crates_and_Packing__c, Unit_Price_USD__c, ChargeUnit__c, Product_Name__c, m2__c, m3__c, ml__c, Total_Price_USD__c, L_Quote__c, W_Quote__c, H_Quote__c, PCS_Quote__c, Crates_Quote__c, Charge_Unit_Quote__c, Packing_Quote__c, Quote_Line_Item_Number_Quote__c, Opportunity_Id__c, Quote_display_name__c, Quote.Id, Quote.OwnerId, Quote.IsDeleted, Quote.Name, Quote.RecordTypeId, Quote.CreatedDate, Quote.CreatedById, Quote.LastModifiedDate, Quote.LastModifiedById, Quote.SystemModstamp, Quote.LastViewedDate, Quote.LastReferencedDate, Quote.OpportunityId, Quote.Pricebook2Id, Quote.ContactId, Quote.QuoteNumber, Quote.IsSyncing, Quote.ShippingHandling, Quote.Tax, Quote.Status, Quote.ExpirationDate, Quote.Description, Quote.Subtotal, Quote.TotalPrice, Quote.LineItemCount, Quote.BillingStreet, Quote.BillingCity, Quote.BillingState, Quote.BillingPostalCode, Quote.BillingCountry, Quote.BillingLatitude, Quote.BillingLongitude, Quote.BillingGeocodeAccuracy, Quote.BillingAddress, Quote.ShippingStreet, Quote.ShippingCity, Quote.ShippingState, Quote.ShippingPostalCode, Quote.ShippingCountry, Quote.ShippingLatitude, Quote.ShippingLongitude, Quote.ShippingGeocodeAccuracy, Quote.ShippingAddress, Quote.QuoteToStreet, Quote.QuoteToCity, Quote.QuoteToState, Quote.QuoteToPostalCode, Quote.QuoteToCountry, Quote.QuoteToLatitude, Quote.QuoteToLongitude, Quote.QuoteToGeocodeAccuracy, Quote.QuoteToAddress, Quote.AdditionalStreet, Quote.AdditionalCity, Quote.AdditionalState, Quote.AdditionalPostalCode, Quote.AdditionalCountry, Quote.AdditionalLatitude, Quote.AdditionalLongitude, Quote.AdditionalGeocodeAccuracy, Quote.AdditionalAddress, Quote.BillingName, Quote.ShippingName, Quote.QuoteToName, Quote.AdditionalName, Quote.Email, Quote.Phone, Quote.Fax, Quote.ContractId, Quote.AccountId, Quote.Discount, Quote.GrandTotal, Quote.CanCreateQuoteLineItems, Quote.Sub_Total_USD__c, Quote.Fumigation__c, Quote.Total_Crates__c, Quote.Total_m3__c, Quote.Total_Tons__c, Quote.Total_Conts__c, Quote.REMARK_NUMBER_ON_DOCUMENTS__c, Quote.Packing__c, Quote.Shipping_Schedule__c, Quote.Port_of_Discharge__c, Quote.Export_Route_Carrier__c, Quote.In_words__c, Quote.Discount__c, Quote.Total_Price_USD__c, Quote.Total_Quote_Line_Items__c, Quote.Port_of_Origin__c, Quote.Stockyard__c, Quote.Created_Date__c, Quote.Discount_Amount__c, Quote.Is_new_quote__c, Quote.First_approved_by__c, Quote.Final_approved_by__c, Quote.Account_approved_pricebook__c, Quote.Is_approved__c, Quote.Terms_of_Sale__c, Quote.Terms_of_Payment__c, Quote.Incoterms__c, 
+           Quote.Account.Name, Quote.Account.BillingStreet, Quote.Account.BillingCity, Quote.Account.BillingPostalCode, Quote.Account.BillingCountry, Quote.Account.Phone, Quote.Account.Fax__c, Quote.Account.VAT__c 
     FROM QuoteLineItem 
     WHERE QuoteId = '{quote_id}' 
     ORDER BY Quote_Line_Item_Number_Quote__c ASC
@@ -3837,6 +4087,8 @@ def generate_quote_no_discount_logic(quote_id, template_path):
         else:
             raise ValueError("Quote data missing in line items.")
 
+    # The Account comes with the line items as Quote.Account.*
+    account = quote_data.pop('Account', None)
     full_data = {}
     for k, v in quote_data.items():
         full_data[f"Quote.{k}"] = v
@@ -3858,20 +4110,14 @@ def generate_quote_no_discount_logic(quote_id, template_path):
     full_data['Quote.Total_Tons__c'] = total_tons
     full_data['Quote.Total_Conts__c'] = total_conts
     # --------------------------------
-    account_id = quote_data.get('AccountId')
-    if account_id:
-        acc_fields = ["Name", "BillingStreet", "BillingCity", "BillingPostalCode", "BillingCountry", "Phone", "Fax__c", "VAT__c"]
-        try:
-            acc = sf.Account.get(account_id)
-            for k in acc_fields:
-                full_data[f"Quote.Account.{k}"] = acc.get(k)
-        except Exception as e:
-            print(f"Error fetching account: {e}")
+    if account:
+        for k in QUOTE_ACCOUNT_FIELDS:
+            full_data[f"Quote.Account.{k}"] = account.get(k)
     
     for idx, item in enumerate(quote_items):
         item['Quote_Line_Item_Number_Quote__c'] = idx + 1
     
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
     
     for row in ws.iter_rows():
@@ -4010,13 +4256,13 @@ def generate_quote_no_discount_logic(quote_id, template_path):
             else:
                 if row_idx - 1 > start_merge_row:
                     ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=row_idx-1, end_column=col_b_idx)
-                    ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                    ws.cell(row=start_merge_row, column=col_b_idx).alignment = ALIGN_LEFT
                 start_merge_row = row_idx
                 current_val = cell_val
         last_row = table_start_row + len(quote_items) - 1
         if last_row > start_merge_row:
              ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=last_row, end_column=col_b_idx)
-             ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+             ws.cell(row=start_merge_row, column=col_b_idx).alignment = ALIGN_LEFT
  
     if table_start_row and quote_items:
         for i in range(len(quote_items)):
@@ -4049,22 +4295,13 @@ def generate_quote_no_discount_logic(quote_id, template_path):
     safe_name = sanitize_filename(quote_data.get('Name'))
     file_name = f"Quote_{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
 
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": quote_id
-    })
+    content_version = upload_content_version(sf, file_name, data, quote_id)
     
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"]
     }
@@ -4076,7 +4313,7 @@ async def generate_quote_no_discount_endpoint(quote_id: str):
         if not os.path.exists(template_path):
              raise HTTPException(status_code=404, detail=f"Quote Template not found")
 
-        result = generate_quote_no_discount_logic(quote_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_quote_no_discount_logic, quote_id, template_path)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -4119,7 +4356,7 @@ def get_production_order_data(sf, contract_id):
 
 def fill_production_order_template(template_path, output_path, contract_data, products_data):
     print(f"Filling template: {template_path}")
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
 
     # Flatten contract data for easier replacement
@@ -4229,14 +4466,6 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
         else:
             total_row = table_start_row + num_items # Vị trí nếu không tìm thấy dòng tổng cộng
 
-        # Define styles
-        thin_border = Border(left=Side(style='thin'), 
-                             right=Side(style='thin'), 
-                             top=Side(style='thin'), 
-                             bottom=Side(style='thin'))
-        align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
-
         # 2. Copy styles (Giữ nguyên logic copy style)
         if num_items > 1:
             for i in range(1, num_items):
@@ -4282,7 +4511,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                         pass
                 
                 cell = ws.cell(row=row_idx, column=col)
-                cell.border = thin_border 
+                cell.border = THIN_BORDER 
 
             # Map item fields
             item_map = {
@@ -4298,13 +4527,13 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
 
             # Write data - columns A through O
             ws.cell(row=row_idx, column=1).value = i + 1 
-            ws.cell(row=row_idx, column=1).alignment = align_center
+            ws.cell(row=row_idx, column=1).alignment = ALIGN_CENTER
             
             ws.cell(row=row_idx, column=2).value = item_map["Order__r.Name"]
-            ws.cell(row=row_idx, column=2).alignment = align_center
+            ws.cell(row=row_idx, column=2).alignment = ALIGN_CENTER
             
             ws.cell(row=row_idx, column=3).value = item_map["SKU__c"]
-            ws.cell(row=row_idx, column=3).alignment = align_left
+            ws.cell(row=row_idx, column=3).alignment = ALIGN_LEFT
             
             desc_val = item_map["Vietnamese_Description__c"] or ""
             
@@ -4315,14 +4544,14 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                 normal_part = '-' + parts[1]
                 
                 rich_text = CellRichText(
-                    TextBlock(InlineFont(b=True, rFont='Times New Roman', sz=11), bold_part),
-                    TextBlock(InlineFont(b=False, rFont='Times New Roman', sz=11), normal_part)
+                    TextBlock(PO_DESC_BOLD_FONT, bold_part),
+                    TextBlock(PO_DESC_REGULAR_FONT, normal_part)
                 )
                 ws.cell(row=row_idx, column=4).value = rich_text
             else:
                 ws.cell(row=row_idx, column=4).value = desc_val
             
-            ws.cell(row=row_idx, column=4).alignment = align_left
+            ws.cell(row=row_idx, column=4).alignment = ALIGN_LEFT
             
             # Auto-adjust row height (Giữ nguyên phần này)
             desc_str = str(desc_val)
@@ -4357,7 +4586,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
             ws.cell(row=row_idx, column=13).value = item_map["Cont__c"]
             
             for col in range(5, 14):
-                ws.cell(row=row_idx, column=col).alignment = align_center
+                ws.cell(row=row_idx, column=col).alignment = ALIGN_CENTER
 
             packing_val = item_map["Packing__c"]
             if packing_val:
@@ -4367,7 +4596,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                 except (ValueError, TypeError):
                     ws.cell(row=row_idx, column=14).value = f"{packing_val}\nviên/kiện"
                 
-                ws.cell(row=row_idx, column=14).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                ws.cell(row=row_idx, column=14).alignment = ALIGN_CENTER
             
             del_date = item_map["Delivery_Date__c"]
             if del_date:
@@ -4376,11 +4605,11 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                     ws.cell(row=row_idx, column=15).value = dt.strftime("%d/%m/%Y")
                 except:
                     ws.cell(row=row_idx, column=15).value = del_date
-            ws.cell(row=row_idx, column=15).alignment = align_center
+            ws.cell(row=row_idx, column=15).alignment = ALIGN_CENTER
 
             # Apply borders
             for col in range(1, 16):
-                ws.cell(row=row_idx, column=col).border = thin_border
+                ws.cell(row=row_idx, column=col).border = THIN_BORDER
     
     
     # ----------------------------------------------------
@@ -4436,8 +4665,8 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
         for col in range(8, 14): 
             cell = ws.cell(row=total_row, column=col)
             cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(bold=True, name='Times New Roman', size=11)
-            cell.border = thin_border
+            cell.font = BOLD_TNR_FONT
+            cell.border = THIN_BORDER
 
     # ----------------------------------------------------
     # MERGE I, J, K FOR ROWS WITH "Người soạn lệnh" OR "Ngọc Bích"
@@ -4455,7 +4684,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
             # Merge columns I (9), J (10), K (11)
             try:
                 ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
-                ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                ws.cell(row=r, column=9).alignment = ALIGN_CENTER
             except Exception as e:
                 print(f"Error merging IJK at row {r}: {e}")
 
@@ -4490,7 +4719,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                     # Merge cells
                     ws.merge_cells(start_row=merge_start_row, start_column=4, end_row=r-1, end_column=4)
                     # Giữ nguyên căn chỉnh cho ô đầu tiên sau khi merge
-                    ws.cell(row=merge_start_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+                    ws.cell(row=merge_start_row, column=4).alignment = ALIGN_LEFT
                 
                 merge_start_row = r
                 current_val_str = val_str
@@ -4513,7 +4742,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                     # Merge cells
                     ws.merge_cells(start_row=merge_start_row, start_column=15, end_row=r-1, end_column=15)
                     # Giữ nguyên căn chỉnh cho ô đầu tiên sau khi merge
-                    ws.cell(row=merge_start_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                    ws.cell(row=merge_start_row, column=15).alignment = ALIGN_CENTER
                 
                 merge_start_row = r
                 current_val = val
@@ -4523,6 +4752,8 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
 
 @app.get("/generate-production-order/{contract_id}")
 async def generate_production_order_endpoint(contract_id: str):
+    if not SF_ID_RE.match(contract_id):
+        raise HTTPException(status_code=400, detail=f"Invalid Salesforce ID: {contract_id}")
     try:
         template_path = os.getenv('PO_TEMPLATE_PATH', 'templates/production_order_template.xlsx')
         if not os.path.exists(template_path):
@@ -4530,7 +4761,7 @@ async def generate_production_order_endpoint(contract_id: str):
              template_path = 'production_order_template.xlsx'
              
         # Call the UPDATED function directly
-        result = generate_production_order_file(contract_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_production_order_file, contract_id, template_path)
         return result
 
     except Exception as e:
@@ -4579,7 +4810,7 @@ def fetch_base_jobs_map(workflow_id, access_token):
             "page_size": page_size
         }
         try:
-            resp = requests.post(url_list, data=payload, timeout=30)
+            resp = BASE_SESSION.post(url_list, data=payload, timeout=BASE_TIMEOUT)
             if resp.status_code != 200:
                 print(f"Error fetching Base jobs: {resp.text}")
                 break
@@ -4621,8 +4852,6 @@ async def sync_base_workflow(case_id: str = None):
         if not base_token:
             raise HTTPException(status_code=500, detail="BASE_ACCESS_TOKEN not set")
 
-        sf = get_salesforce_connection()
-        
         query_fields = "Id, CaseNumber, Subject, CreatedDate, So_LSX__c, Date_Export__c, Link_BM02__c, Number_Container__c, Customer_Complain_Content__c, Account.Account_Code__c"
         
         if case_id:
@@ -4630,7 +4859,9 @@ async def sync_base_workflow(case_id: str = None):
         else:
             query = f"SELECT {query_fields} FROM Case ORDER BY CreatedDate DESC LIMIT 1"
             
-        result = sf.query_all(query)
+        def fetch_case():
+            return get_salesforce_connection().query_all(query)
+        result = await asyncio.to_thread(run_with_salesforce_session, fetch_case)
         if not result['records']:
             return {"status": "error", "message": "No case found"}
             
@@ -4661,13 +4892,13 @@ async def sync_base_workflow(case_id: str = None):
         if subject in base_jobs_map:
             job_id_base = base_jobs_map[subject]
             payload['id'] = job_id_base
-            resp = requests.post(url_edit, data=payload)
+            resp = BASE_SESSION.post(url_edit, data=payload, timeout=BASE_TIMEOUT)
             action = "UPDATE"
         else:
             payload['workflow_id'] = workflow_id
             payload['creator_username'] = creator
             payload['followers'] = followers
-            resp = requests.post(url_create, data=payload)
+            resp = BASE_SESSION.post(url_create, data=payload, timeout=BASE_TIMEOUT)
             action = "CREATE"
             
         try:
@@ -4703,19 +4934,9 @@ def expand_case_items_table(ws, template_row, n):
     row_height = ws.row_dimensions[template_row].height
     add_rows = max(0, n - 1)
     
-    # Handle merged cells
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-    
     # Insert rows
     if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
+        insert_rows_keeping_merges(ws, template_row + 1, add_rows)
         for offset in range(1, add_rows + 1):
             r = template_row + offset
             for col in range(1, max_col + 1):
@@ -4726,13 +4947,6 @@ def expand_case_items_table(ws, template_row, n):
                     dst._style = style_copy(st)
             if row_height is not None:
                 ws.row_dimensions[r].height = row_height
-    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
 
 
 def generate_case_report(case_id: str, template_path: str):
@@ -4784,7 +4998,7 @@ def generate_case_report(case_id: str, template_path: str):
         products = prod_res['records']
         
     # 4. Load Template
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active # Assuming the template has only 1 sheet or active one is correct
     
     # helper for dates
@@ -4995,27 +5209,24 @@ def generate_case_report(case_id: str, template_path: str):
     
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
     try:
-        content_version = sf.ContentVersion.create({
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": case_id
-        })
+        content_version = upload_content_version(sf, file_name, data, case_id)
         cv_id = content_version['id']
+    except SalesforceExpiredSession:
+        raise
     except Exception as e:
         print(f"Failed to upload to Salesforce: {e}")
         cv_id = None
+        # Serverless skipped the local copy; keep one so /download can still serve it
+        if saved_path is None:
+            file_path.write_bytes(data)
+            saved_path = file_path
 
     return {
-        "file_path": str(file_path),
+        "file_path": str(saved_path) if saved_path else None,
         "file_name": file_name,
         "salesforce_content_version_id": cv_id
     }
@@ -5106,6 +5317,8 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
     
     try:
         result = sf.query_all(query)
+    except SalesforceExpiredSession:
+        raise
     except Exception as e:
         raise Exception(f"Error querying Case: {e}")
         
@@ -5144,6 +5357,8 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
                          "Width": item.get('Width__c'),
                          "Height": item.get('Height__c')
                      })
+        except SalesforceExpiredSession:
+            raise
         except Exception as e:
             print(f"Error querying Contract/Products: {e}")
 
@@ -5155,7 +5370,7 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
          else:
              raise FileNotFoundError(f"Template not found: {template_path}")
              
-    wb = openpyxl.load_workbook(template_path)
+    wb = load_template_workbook(template_path)
     ws = wb.active
     
     # Sanitize Template
@@ -5238,7 +5453,6 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
                 
                 if images:
                     from io import BytesIO
-                    import requests
                     
                     col_letter = get_column_letter(9) # Photos column
                     
@@ -5251,7 +5465,7 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
                         img_url = f"{sf.base_url}sobjects/ContentVersion/{cv_id}/VersionData"
                         headers = {'Authorization': f'Bearer {sf.session_id}'}
                         
-                        img_res = requests.get(img_url, headers=headers)
+                        img_res = sf.session.get(img_url, headers=headers)
                         if img_res.status_code == 200:
                             img_stream = BytesIO(img_res.content)
                             try:
@@ -5345,35 +5559,32 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
     file_path = output_dir / file_name
     
     print(f"Saving to local output: {file_path}")
-    wb.save(str(file_path))
+    data, saved_path = save_workbook_bytes(wb, file_path)
 
     # Upload to Salesforce
     print(f"Uploading to Salesforce for Case: {case_id}")
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
     try:
-        content_version = sf.ContentVersion.create({
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": case_id
-        })
+        content_version = upload_content_version(sf, file_name, data, case_id)
         print(f"Upload Success! ContentVersion ID: {content_version['id']}")
         
         return {
             "status": "success",
-            "file_path": str(file_path),
+            "file_path": str(saved_path) if saved_path else None,
             "file_name": file_name,
             "salesforce_content_version_id": content_version["id"],
             "message": "Report generated and attached to Case successfully"
         }
+    except SalesforceExpiredSession:
+        raise
     except Exception as e:
         print(f"Upload failed: {e}")
+        # Serverless skipped the local copy; keep one so /download can still serve it
+        if saved_path is None:
+            file_path.write_bytes(data)
+            saved_path = file_path
         return {
             "status": "partial_success",
-            "file_path": str(file_path),
+            "file_path": str(saved_path) if saved_path else None,
             "message": f"Generated file locally but failed to upload: {e}"
         }
 
@@ -5394,7 +5605,7 @@ async def generate_case_report_endpoint(case_id: str):
         if not os.path.exists(template_path):
              raise HTTPException(status_code=404, detail=f"Template not found: {template_path}")
              
-        result = generate_case_report(case_id, template_path)
+        result = await asyncio.to_thread(run_with_salesforce_session, generate_case_report, case_id, template_path)
         return {
             "status": "success",
             "data": result
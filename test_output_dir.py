@@ -4,12 +4,15 @@ Test script to verify get_output_directory() works correctly
 """
 import os
 from pathlib import Path
+from functools import lru_cache
 
+@lru_cache(maxsize=1)
 def get_output_directory() -> Path:
     """
     Get the appropriate output directory based on environment.
     Use /tmp for serverless environments (Vercel, AWS Lambda) where filesystem is read-only.
     Use ./output for local development.
+    Resolved (and created) once per process - the environment does not change.
     """
     # Check if we're in a serverless environment
     is_serverless = (
@@ -40,6 +43,7 @@ if __name__ == "__main__":
     # Test Vercel environment
     print("2. Vercel environment (VERCEL=1):")
     os.environ['VERCEL'] = '1'
+    get_output_directory.cache_clear()
     output_dir = get_output_directory()
     print(f"   Output directory: {output_dir}")
     print(f"   Is /tmp: {output_dir == Path('/tmp')}")
@@ -49,6 +53,7 @@ if __name__ == "__main__":
     # Test AWS Lambda environment
     print("3. AWS Lambda environment (AWS_LAMBDA_FUNCTION_NAME=test):")
     os.environ['AWS_LAMBDA_FUNCTION_NAME'] = 'test'
+    get_output_directory.cache_clear()
     output_dir = get_output_directory()
     print(f"   Output directory: {output_dir}")
     print(f"   Is /tmp: {output_dir == Path('/tmp')}")
@@ -1,8 +1,28 @@
 import requests
 import os
 import glob
+from collections import defaultdict
 import openpyxl
 from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.xml.constants import SHEET_MAIN_NS
+from xml.etree import ElementTree
+import re
+
+# Case-insensitive as the label's case comes from the template
+TOTAL_LABEL_RE = re.compile(r'TỔNG CỘNG', re.IGNORECASE)
+
+def read_merged_ranges(wb, ws):
+    """Merged ranges of a read-only worksheet, parsed from its <mergeCell> elements
+    (read-only mode does not load ws.merged_cells)"""
+    merge_tag = f"{{{SHEET_MAIN_NS}}}mergeCell"
+    ranges = []
+    with wb._archive.open(ws._worksheet_path) as src:
+        for _, el in ElementTree.iterparse(src):
+            if el.tag == merge_tag:
+                ranges.append(CellRange(el.get("ref")))
+            el.clear()
+    return ranges
 
 def verify_po():
     # 1. Trigger endpoint
@@ -27,16 +47,35 @@ def verify_po():
     latest_file = max(files, key=os.path.getctime)
     print(f"Checking file: {latest_file}")
     
-    wb = openpyxl.load_workbook(latest_file)
+    # Read-only: rows are streamed from the sheet XML instead of building the full
+    # styled cell tree. ws.cell() would re-parse the sheet on every call there, so
+    # the rows are read once and indexed
+    wb = openpyxl.load_workbook(latest_file, read_only=True)
     ws = wb.active
+    rows = list(ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column))
+    merged_ranges = read_merged_ranges(wb, ws)
+    wb.close()
+
+    # Index the merged ranges once: (row, column) -> range containing it, and the
+    # ranges by first column, instead of testing every range per looked-up cell
+    merge_index = {}
+    merged_by_col = defaultdict(list)
+    for merged_range in merged_ranges:
+        merged_by_col[merged_range.min_col].append(merged_range)
+        for r in range(merged_range.min_row, merged_range.max_row + 1):
+            for c in range(merged_range.min_col, merged_range.max_col + 1):
+                merge_index.setdefault((r, c), merged_range)
+
+    def cell_at(row, column):
+        return rows[row - 1][column - 1]
     
     # 3. Verify Totals (Formulas)
     # Assuming totals are in columns H-M (8-13)
     # Find Total row
     total_row = None
-    for r in range(1, ws.max_row + 1):
-        val = ws.cell(row=r, column=4).value
-        if val and "TỔNG CỘNG" in str(val).upper():
+    for r, row in enumerate(rows, start=1):
+        val = row[3].value
+        if isinstance(val, str) and TOTAL_LABEL_RE.search(val):
             total_row = r
             break
             
@@ -49,7 +88,7 @@ def verify_po():
         cols_to_check = [8, 9, 10, 11, 12, 13]
         all_formulas = True
         for col in cols_to_check:
-            cell = ws.cell(row=total_row, column=col)
+            cell = cell_at(total_row, col)
             val = cell.value
             if not isinstance(val, str) or not val.startswith("=SUM"):
                 print(f"FAIL: Column {get_column_letter(col)} does not have SUM formula. Value: {val}")
@@ -63,18 +102,15 @@ def verify_po():
         # Check unmerged
         is_merged = False
         for col in cols_to_check:
-            cell = ws.cell(row=total_row, column=col)
-            for merged_range in ws.merged_cells.ranges:
-                if cell.coordinate in merged_range:
-                    is_merged = True
-                    print(f"FAIL: Cell {cell.coordinate} is merged.")
-                    break
+            if (total_row, col) in merge_index:
+                is_merged = True
+                print(f"FAIL: Cell {get_column_letter(col)}{total_row} is merged.")
         if not is_merged:
             print("PASS: Total cells are not merged.")
 
         # Check formatting (Bold, Center, Border)
         # Just checking one cell as sample
-        cell = ws.cell(row=total_row, column=8)
+        cell = cell_at(total_row, 8)
         if cell.font.bold:
             print("PASS: Total row is Bold.")
         else:
@@ -92,22 +128,20 @@ def verify_po():
 
     # 4. Verify "Ngọc Bích" and Merge I-K
     signer_found = False
-    for r in range(1, ws.max_row + 1):
-        val = ws.cell(row=r, column=9).value
+    for r, row in enumerate(rows, start=1):
+        val = row[8].value
         if val == "Ngọc Bích":
             signer_found = True
             print(f"PASS: Found 'Ngọc Bích' at row {r}")
             # Check merge
-            cell = ws.cell(row=r, column=9)
             is_merged_correctly = False
-            for merged_range in ws.merged_cells.ranges:
-                if cell.coordinate in merged_range:
-                    if merged_range.min_col == 9 and merged_range.max_col == 11: # I to K
-                        is_merged_correctly = True
-                        print(f"PASS: 'Ngọc Bích' cell is merged I-K ({merged_range})")
-                    else:
-                        print(f"FAIL: 'Ngọc Bích' cell merged range is {merged_range}, expected I-K")
-                    break
+            merged_range = merge_index.get((r, 9))
+            if merged_range is not None:
+                if merged_range.min_col == 9 and merged_range.max_col == 11: # I to K
+                    is_merged_correctly = True
+                    print(f"PASS: 'Ngọc Bích' cell is merged I-K ({merged_range})")
+                else:
+                    print(f"FAIL: 'Ngọc Bích' cell merged range is {merged_range}, expected I-K")
             if not is_merged_correctly:
                 print("FAIL: 'Ngọc Bích' cell is NOT merged correctly.")
             break
@@ -122,13 +156,8 @@ def verify_po():
     print("Checking merges in Product Name (D) and Delivery Date (O)...")
     # Assuming data starts around row 13 (or where table starts)
     # We can just list merged ranges in those columns
-    merged_D = []
-    merged_O = []
-    for merged_range in ws.merged_cells.ranges:
-        if merged_range.min_col == 4 and merged_range.max_col == 4:
-            merged_D.append(str(merged_range))
-        if merged_range.min_col == 15 and merged_range.max_col == 15:
-            merged_O.append(str(merged_range))
+    merged_D = [str(mr) for mr in merged_by_col[4] if mr.max_col == 4]
+    merged_O = [str(mr) for mr in merged_by_col[15] if mr.max_col == 15]
             
     print(f"Merged ranges in Column D: {merged_D}")
     print(f"Merged ranges in Column O: {merged_O}")